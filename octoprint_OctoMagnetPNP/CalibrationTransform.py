@@ -0,0 +1,164 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import math
+
+class CalibrationError(ValueError):
+    pass
+
+
+class CalibrationTransform():
+    """
+    Maps CAD coordinates of the part destinations to bed coordinates.
+
+    Fitted by least squares from reference points, pairs of ([cad x, cad y], [bed x, bed y]).
+    Mode "affine" corrects offset, rotation, scale and skew. It needs 3 points, with 1 point
+    only the offset and with 2 points offset, rotation and scale are corrected. Mode
+    "homography" also corrects a perspective distortion and needs 4 points. Coordinates are
+    normalized before fitting, the result is kept as a 3x3 matrix.
+    """
+
+    MODES = ("none", "affine", "homography")
+
+    def __init__(self, mode="none", points=()):
+        if mode not in self.MODES:
+            raise CalibrationError("unknown mode " + repr(mode))
+        self.mode = mode
+        self._matrix = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+        self.residual = 0.0 # root mean square error at the reference points in mm
+        if mode == "none":
+            return
+
+        points = [(tuple(float(v) for v in cad[:2]), tuple(float(v) for v in bed[:2])) for cad, bed in points]
+        if mode == "homography" and len(points) < 4:
+            raise CalibrationError("homography needs at least 4 reference points")
+        if not points:
+            raise CalibrationError("no reference points")
+
+        cadNorm = _normalization([cad for cad, bed in points])
+        bedNorm = _normalization([bed for cad, bed in points])
+        normalized = [(_apply(cadNorm, cad), _apply(bedNorm, bed)) for cad, bed in points]
+        if mode == "homography":
+            fitted = _fitHomography(normalized)
+        elif len(points) == 1:
+            fitted = _fitTranslation(normalized)
+        elif len(points) == 2:
+            fitted = _fitSimilarity(normalized)
+        else:
+            fitted = _fitAffine(normalized)
+        self._matrix = _multiply(_invertNormalization(bedNorm), _multiply(fitted, cadNorm))
+
+        errors = [_squaredDistance(self.apply(*cad), bed) for cad, bed in points]
+        self.residual = math.sqrt(sum(errors) / len(errors))
+
+    def isIdentity(self):
+        return self.mode == "none"
+
+    def apply(self, x, y):
+        return _apply(self._matrix, (x, y))
+
+    # transform a list of (x, y) in one go, returns a list of (x, y)
+    def applyAll(self, points):
+        (a, b, c), (d, e, f), (g, h, i) = self._matrix
+        if g == 0.0 and h == 0.0 and i == 1.0:
+            return [(a * x + b * y + c, d * x + e * y + f) for x, y in points]
+        result = []
+        for x, y in points:
+            w = g * x + h * y + i
+            result.append(((a * x + b * y + c) / w, (d * x + e * y + f) / w))
+        return result
+
+    # rotation of the CAD x axis on the bed at (x, y) in degrees, counter-clockwise, for a list of (x, y)
+    def getRotations(self, points):
+        (a, b, c), (d, e, f), (g, h, i) = self._matrix
+        result = []
+        for x, y in points:
+            w = g * x + h * y + i
+            u = a * x + b * y + c
+            v = d * x + e * y + f
+            result.append(math.degrees(math.atan2(d * w - v * g, a * w - u * g)))
+        return result
+
+    def toList(self):
+        return [list(row) for row in self._matrix]
+
+
+def _apply(matrix, point):
+    (a, b, c), (d, e, f), (g, h, i) = matrix
+    x, y = point
+    w = g * x + h * y + i
+    if abs(w) < 1e-12:
+        raise CalibrationError("point is mapped to infinity")
+    return ((a * x + b * y + c) / w, (d * x + e * y + f) / w)
+
+def _multiply(m, n):
+    return tuple(tuple(sum(m[r][k] * n[k][c] for k in range(3)) for c in range(3)) for r in range(3))
+
+def _squaredDistance(p, q):
+    return (p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2
+
+# similarity which moves the centroid of points to the origin with a mean distance of sqrt(2) (Hartley normalization)
+def _normalization(points):
+    cx = sum(p[0] for p in points) / len(points)
+    cy = sum(p[1] for p in points) / len(points)
+    mean = sum(math.hypot(p[0] - cx, p[1] - cy) for p in points) / len(points)
+    scale = math.sqrt(2) / mean if mean > 1e-9 else 1.0
+    return ((scale, 0.0, -scale * cx), (0.0, scale, -scale * cy), (0.0, 0.0, 1.0))
+
+def _invertNormalization(matrix):
+    scale = matrix[0][0]
+    return ((1.0 / scale, 0.0, -matrix[0][2] / scale), (0.0, 1.0 / scale, -matrix[1][2] / scale), (0.0, 0.0, 1.0))
+
+def _fitTranslation(points):
+    (x, y), (u, v) = points[0]
+    return ((1.0, 0.0, u - x), (0.0, 1.0, v - y), (0.0, 0.0, 1.0))
+
+# u = a x - b y + c, v = b x + a y + d
+def _fitSimilarity(points):
+    rows = []
+    values = []
+    for (x, y), (u, v) in points:
+        rows += [(x, -y, 1.0, 0.0), (y, x, 0.0, 1.0)]
+        values += [u, v]
+    a, b, c, d = _leastSquares(rows, values)
+    return ((a, -b, c), (b, a, d), (0.0, 0.0, 1.0))
+
+def _fitAffine(points):
+    rows = []
+    values = []
+    for (x, y), (u, v) in points:
+        rows += [(x, y, 1.0, 0.0, 0.0, 0.0), (0.0, 0.0, 0.0, x, y, 1.0)]
+        values += [u, v]
+    a, b, c, d, e, f = _leastSquares(rows, values)
+    return ((a, b, c), (d, e, f), (0.0, 0.0, 1.0))
+
+# direct linear transformation with the bottom right element fixed to 1
+def _fitHomography(points):
+    rows = []
+    values = []
+    for (x, y), (u, v) in points:
+        rows += [(x, y, 1.0, 0.0, 0.0, 0.0, -x * u, -y * u), (0.0, 0.0, 0.0, x, y, 1.0, -x * v, -y * v)]
+        values += [u, v]
+    a, b, c, d, e, f, g, h = _leastSquares(rows, values)
+    return ((a, b, c), (d, e, f), (g, h, 1.0))
+
+# solve the normal equations of rows * x = values with Gaussian elimination
+def _leastSquares(rows, values):
+    n = len(rows[0])
+    system = [[sum(row[i] * row[j] for row in rows) for j in range(n)] + [sum(row[i] * value for row, value in zip(rows, values))]
+              for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(system[r][col]))
+        if abs(system[pivot][col]) < 1e-9:
+            raise CalibrationError("reference points are degenerate, e.g. on a line")
+        system[col], system[pivot] = system[pivot], system[col]
+        for r in range(n):
+            if r != col:
+                factor = system[r][col] / system[col][col]
+                if factor:
+                    system[r] = [vr - factor * vc for vr, vc in zip(system[r], system[col])]
+    return [system[i][n] / system[i][i] for i in range(n)]
@@ -0,0 +1,154 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import itertools
+import math
+
+class MotionProfile():
+    """
+    Feedrates, dwell times and safe travel heights for the pick and place cycle.
+
+    The global values can be overridden per nut type (nut_profiles, a dict of
+    nut type -> parameters) and per tray box (the same keys added to an entry
+    of the box configuration). Box values take precedence over nut values.
+    """
+
+    # feedrates in mm/min (rotation in E-units/min), dwell times in ms
+    PARAMETERS = ("feedrate_xy", "feedrate_z", "feedrate_rotation", "settle_dwell", "grip_dwell", "release_dwell")
+
+    def __init__(self, defaults, nut_profiles, boxes, clearance):
+        self._defaults = dict((key, float(defaults[key])) for key in self.PARAMETERS)
+        self._nutProfiles = nut_profiles
+        self._boxes = boxes
+        self._clearance = float(clearance)
+        self._parameters = {}
+        self._travelHeights = {}
+        self._partHeights = {}
+
+    # parameters for a part from tray box nr box with nut type nut
+    def getParameters(self, box, nut):
+        key = (box, nut)
+        if key not in self._parameters:
+            parameters = dict(self._defaults)
+            overrides = [self._nutProfiles.get(nut, {})]
+            if box is not None and 0 <= box < len(self._boxes):
+                overrides.append(self._boxes[box])
+            for override in overrides:
+                for name in self.PARAMETERS:
+                    if name in override:
+                        parameters[name] = float(override[name])
+            self._parameters[key] = parameters
+        return self._parameters[key]
+
+    # Compute the lowest safe height of the magnet while carrying each part, when the parts are placed
+    # in file order. The part hanging below the magnet has to clear the tray and the top of all parts
+    # which are placed at or below its own destination height, since those might already be on the object.
+    def computeTravelHeights(self, smdparts, tray_z):
+        self._travelHeights = {}
+        self._partHeights = dict((partnr, smdparts.getPartHeight(partnr)) for partnr in smdparts.getPartIds())
+        destinationZ = lambda partnr: smdparts.getPartDestination(partnr)[2]
+        top = float(tray_z)
+        for _, layer in itertools.groupby(sorted(smdparts.getPartIds(), key=destinationZ), key=destinationZ):
+            layer = list(layer)
+            top = max([top] + [destinationZ(partnr) + self._partHeights[partnr] for partnr in layer])
+            for partnr in layer:
+                self._travelHeights[partnr] = top + self._partHeights[partnr] + self._clearance
+
+    # travel height of a part, with top it also clears everything up to this height (the print, parts placed before)
+    def getTravelHeight(self, partnr, top=None):
+        height = self._travelHeights[partnr]
+        if top is not None:
+            height = max(height, top + self._partHeights[partnr] + self._clearance)
+        return height
+
+
+class MoveSequence():
+    """
+    Gcode commands of one step of the pick and place cycle. Keeps track of the head
+    position to skip redundant moves and to estimate the duration (without acceleration).
+    Moves are only combined if both end points are at a safe height.
+    """
+
+    def __init__(self, position=None):
+        self.commands = []
+        self.duration = 0.0 # seconds
+        # [x, y, z], single coordinates or the whole position are None if unknown
+        self.position = list(position) if position is not None else [None, None, None]
+
+    def append(self, *commands):
+        self.commands.extend(commands)
+
+    # Move to x, y at height z, which must be safe for travel. With rotation, the part is rotated during
+    # the move, which is slowed down if the rotation would exceed feedrate_rotation. The rotation is done
+    # before the move if the start position is unknown.
+    def travel(self, x, y, z, feedrate_xy, feedrate_z, rotation=None, feedrate_rotation=None):
+        current = self.position[2]
+        if current is None or current < z:
+            # lift vertically first, the head might be at print height
+            self.moveZ(z, feedrate_z)
+            target_z = None
+        else:
+            target_z = z
+        feedrate = feedrate_xy
+        if rotation:
+            distance = self._distance([x, y, z])
+            if distance:
+                feedrate = min(feedrate_xy, feedrate_rotation * distance / abs(rotation))
+                self.commands.append(formatCommand("G92", E=0))
+            else:
+                self.rotate(rotation, feedrate_rotation)
+                rotation = None
+        self.commands.append(formatMove(x=x, y=y, z=target_z, e=rotation or None, f=feedrate))
+        self._addMoveTime([x, y, z], feedrate)
+        self.position = [x, y, z]
+
+    def moveZ(self, z, feedrate):
+        if self.position[2] == z:
+            return
+        self.commands.append(formatMove(z=z, f=feedrate))
+        if self.position[2] is not None:
+            self.duration += abs(z - self.position[2]) * 60.0 / feedrate
+        self.position[2] = z
+
+    def rotate(self, rotation, feedrate):
+        self.commands.append(formatCommand("G92", E=0))
+        self.commands.append(formatMove(e=rotation, f=feedrate))
+        self.duration += abs(rotation) * 60.0 / feedrate
+
+    def dwell(self, ms):
+        if ms > 0:
+            self.commands.append(formatCommand("G4", P=ms))
+            self.duration += ms / 1000.0
+
+    def _addMoveTime(self, target, feedrate):
+        distance = self._distance(target)
+        if distance is not None:
+            self.duration += distance * 60.0 / feedrate
+
+    # distance from the current position to target, None if the position is unknown
+    def _distance(self, target):
+        if None in self.position:
+            return None
+        return math.sqrt(sum((a - b) ** 2 for a, b in zip(self.position, target)))
+
+
+def formatNumber(value):
+    result = "%.3f" % value
+    result = result.rstrip("0").rstrip(".")
+    return "0" if result == "-0" else result
+
+# single formatter for all generated commands, e.g. formatCommand("G4", P=500) -> "G4 P500"
+# code may be a prefix with a number ("T", 2 -> "T2"), parameters with value None are skipped
+def formatCommand(code, number=None, **parameters):
+    parts = [code if number is None else code + formatNumber(float(number))]
+    for name, value in parameters.items():
+        if value is not None:
+            parts.append(name + formatNumber(value))
+    return " ".join(parts)
+
+def formatMove(x=None, y=None, z=None, e=None, f=None):
+    return formatCommand("G1", X=x, Y=y, Z=z, E=e, F=f)
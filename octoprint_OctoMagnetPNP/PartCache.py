@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import json
+import os
+import threading
+import time
+
+class PartCache():
+    """
+    On-disk cache of sanitized part information extracted from gcode files.
+
+    Files are looked up by path, size and modification time, so a hit does not
+    require reading the gcode file at all. The serialized part data is stored
+    once per digest of the XML block, files with an identical part description
+    share a single cache entry. Files without any part information are cached
+    as well, since those require a scan of the whole file.
+    Least recently used files are evicted once the cache exceeds its size limit.
+    """
+
+    INDEX_FILE = "index.json"
+    MAX_SIZE = 50 * 1024 * 1024 # bytes
+    MAX_FILES = 1000
+
+    def __init__(self, folder, max_size=MAX_SIZE, max_files=MAX_FILES):
+        self._folder = folder
+        self._maxSize = max_size
+        self._maxFiles = max_files
+        self._lock = threading.Lock()
+        # path -> dict(size, mtime, digest, used)
+        self._files = {}
+        # digest -> size of the stored part data in bytes
+        self._blobs = {}
+
+        if not os.path.isdir(self._folder):
+            os.makedirs(self._folder)
+        self._readIndex()
+
+    # returns the cached part data for the file at path, b"" for files without parts, or None if the file is not cached
+    def lookup(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                return None
+            data = self._readBlob(entry["digest"])
+            if data is None:
+                self._remove(path)
+                return None
+            entry["used"] = time.time()
+            self._writeIndex()
+            return data
+
+    # returns cached part data for the XML block with the given digest or None
+    def lookupDigest(self, digest):
+        with self._lock:
+            if digest not in self._blobs:
+                return None
+            return self._readBlob(digest)
+
+    # store part data for the file at path, digest identifies the XML block. Use data=b"" and digest=None for files without parts.
+    def store(self, path, digest, data):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            if path in self._files:
+                self._remove(path)
+            if digest is not None and digest not in self._blobs:
+                self._writeFile(self._blobPath(digest), data)
+                self._blobs[digest] = len(data)
+            self._files[path] = dict(size=stat.st_size, mtime=stat.st_mtime_ns, digest=digest, used=time.time())
+            self._evict()
+            self._writeIndex()
+
+    def getSize(self):
+        with self._lock:
+            return sum(self._blobs.values())
+
+    def _evict(self):
+        lru = sorted(self._files, key=lambda path: self._files[path]["used"])
+        while lru and (len(self._files) > self._maxFiles or sum(self._blobs.values()) > self._maxSize):
+            self._remove(lru.pop(0))
+
+    # remove a file entry and the stored part data, if no other file references it
+    def _remove(self, path):
+        digest = self._files.pop(path)["digest"]
+        if digest is None or any(entry["digest"] == digest for entry in self._files.values()):
+            return
+        self._blobs.pop(digest, None)
+        try:
+            os.remove(self._blobPath(digest))
+        except OSError:
+            pass
+
+    def _readBlob(self, digest):
+        if digest is None:
+            return b""
+        try:
+            with open(self._blobPath(digest), "rb") as f:
+                return f.read()
+        except (IOError, OSError):
+            self._blobs.pop(digest, None)
+            return None
+
+    def _blobPath(self, digest):
+        return os.path.join(self._folder, digest + ".xml")
+
+    def _readIndex(self):
+        try:
+            with open(os.path.join(self._folder, self.INDEX_FILE), "r") as f:
+                index = json.load(f)
+            self._files = index["files"]
+            self._blobs = index["blobs"]
+        except (IOError, OSError, ValueError, KeyError):
+            self._files = {}
+            self._blobs = {}
+
+    def _writeIndex(self):
+        self._writeFile(os.path.join(self._folder, self.INDEX_FILE),
+                        json.dumps(dict(files=self._files, blobs=self._blobs)).encode("utf-8"))
+
+    # write via a temporary file, the cache is never left in a half written state
+    def _writeFile(self, path, data):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,110 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+from array import array
+import threading
+
+class PartShape():
+    """
+    Outline of a part, parsed from the <shape> element on first use.
+
+    The points are kept as a flat array of doubles (x0, y0, x1, y1, ...). Bounding
+    box and simplified outlines are computed when they are asked for and cached,
+    computing them twice from different threads is harmless. Parsing consumes the
+    element, it is done once under a lock shared by all shapes.
+    """
+    __slots__ = ("_elem", "_points", "_bounds", "_outlines")
+
+    _parseLock = threading.Lock()
+
+    def __init__(self, elem=None):
+        self._elem = elem
+        self._points = None
+        self._bounds = None
+        self._outlines = {}
+
+    def getPoints(self):
+        points = self._points
+        if points is None:
+            with self._parseLock:
+                points = self._points
+                if points is None:
+                    points = array("d")
+                    if self._elem is not None:
+                        for point in self._elem:
+                            points.append(float(point.get("x")))
+                            points.append(float(point.get("y")))
+                    self._points = points
+                    self._elem = None
+        return points
+
+    def getPointCount(self):
+        return len(self.getPoints()) // 2
+
+    # list of [x, y]
+    def toList(self):
+        points = self.getPoints()
+        return [[points[i], points[i + 1]] for i in range(0, len(points), 2)]
+
+    # (min x, min y, max x, max y), None for parts without shape
+    def getBoundingBox(self):
+        if self._bounds is None:
+            points = self.getPoints()
+            if not points:
+                return None
+            xs = points[0::2]
+            ys = points[1::2]
+            self._bounds = (min(xs), min(ys), max(xs), max(ys))
+        return self._bounds
+
+    # outline as list of [x, y] without details smaller than tolerance (Douglas-Peucker), at least a triangle
+    def getOutline(self, tolerance):
+        if tolerance <= 0 or self.getPointCount() <= 3:
+            return self.toList()
+        if tolerance not in self._outlines:
+            self._outlines[tolerance] = _simplifyPolygon(self.toList(), tolerance)
+        return [list(point) for point in self._outlines[tolerance]]
+
+
+# Douglas-Peucker for a closed polygon: split at the point farthest from the first one and simplify both chains
+def _simplifyPolygon(points, tolerance):
+    first = points[0]
+    split = max(range(len(points)), key=lambda i: (points[i][0] - first[0]) ** 2 + (points[i][1] - first[1]) ** 2)
+    outline = _simplifyChain(points[:split + 1], tolerance)[:-1] + _simplifyChain(points[split:] + [first], tolerance)[:-1]
+    return outline if len(outline) >= 3 else points
+
+# Douglas-Peucker for an open chain, both end points are kept
+def _simplifyChain(points, tolerance):
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        farthest = None
+        distance = tolerance
+        for i in range(start + 1, end):
+            d = _segmentDistance(points[i], points[start], points[end])
+            if d > distance:
+                farthest = i
+                distance = d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return [point for point, kept in zip(points, keep) if kept]
+
+def _segmentDistance(point, a, b):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length = dx * dx + dy * dy
+    if length == 0:
+        t = 0.0
+    else:
+        t = max(0.0, min(1.0, ((point[0] - a[0]) * dx + (point[1] - a[1]) * dy) / length))
+    x = a[0] + t * dx - point[0]
+    y = a[1] + t * dy - point[1]
+    return (x * x + y * y) ** 0.5
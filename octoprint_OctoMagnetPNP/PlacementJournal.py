@@ -0,0 +1,174 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import json
+import os
+import threading
+import time
+
+class PlacementJournal():
+    """
+    Append-only journal of the placements of the current job, one JSON record per line.
+
+    The journal starts with a "job" record naming the gcode file and gets a record
+    for every finished phase of the pick and place cycle and for every placed part.
+    After a restart or a disconnect, the parts of an unfinished job which are
+    already placed can be skipped. Records are written by a background thread,
+    which collects them for up to interval seconds and syncs them to disk once,
+    so placing a part never waits for the disk.
+    """
+
+    FILE_NAME = "journal.log"
+
+    def __init__(self, folder, interval=1.0):
+        self._path = os.path.join(folder, self.FILE_NAME)
+        self._interval = interval
+        self._lock = threading.Lock() # pending records and state
+        self._writeLock = threading.Lock() # the journal file
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._file = None
+        self._thread = None
+
+        self._job = None
+        self._placed = set()
+        self._current = None # part picked but not placed yet
+        self._finished = False
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._read()
+
+    # start the journal of a new job, previous records are discarded
+    def start(self, path):
+        with self._writeLock:
+            with self._lock:
+                self._pending = []
+                self._job = path
+                self._placed = set()
+                self._current = None
+                self._finished = False
+            self._close()
+            self._file = open(self._path, "w")
+            self._writeRecords([dict(event="job", file=path, time=time.time())])
+
+    # continue the journal of the unfinished job
+    def resume(self):
+        self._append(dict(event="resume"))
+
+    # a phase (pick, align or place) of part partnr has been finished
+    def record(self, phase, partnr):
+        with self._lock:
+            self._current = partnr
+        self._append(dict(event=phase, part=partnr))
+
+    def placed(self, partnr):
+        with self._lock:
+            self._placed.add(partnr)
+            self._current = None
+        self._append(dict(event="placed", part=partnr))
+
+    def finish(self):
+        self._append(dict(event="end"))
+        with self._lock:
+            self._finished = True
+        self.flush()
+
+    # forget the unfinished job
+    def discard(self):
+        with self._writeLock:
+            with self._lock:
+                self._pending = []
+                self._job = None
+                self._placed = set()
+                self._current = None
+            self._close()
+            open(self._path, "w").close()
+
+    def isActive(self):
+        with self._lock:
+            return self._job is not None and not self._finished
+
+    # dict(file, placed, current) of an unfinished job with placed parts, None otherwise
+    def getUnfinished(self):
+        with self._lock:
+            if self._job is None or self._finished or not (self._placed or self._current is not None):
+                return None
+            return dict(file=self._job, placed=sorted(self._placed), current=self._current)
+
+    # write all pending records now
+    def flush(self):
+        with self._writeLock:
+            with self._lock:
+                records = self._pending
+                self._pending = []
+            if records:
+                self._writeRecords(records)
+
+    def _append(self, record):
+        record["time"] = time.time()
+        with self._lock:
+            if self._job is None or self._finished:
+                return
+            self._pending.append(record)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="OctoMagnetPNP journal")
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    # background writer: waits for records, collects them for the sync interval and writes them at once
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self._interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _writeRecords(self, records):
+        if self._file is None:
+            self._file = open(self._path, "a")
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # restore the state of the last job, a record cut off by a crash is removed
+    def _read(self):
+        try:
+            valid = 0
+            with open(self._path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete record")
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        break
+                    valid += len(line)
+                    event = record.get("event")
+                    if event == "job":
+                        self._job = record.get("file")
+                        self._placed = set()
+                        self._current = None
+                        self._finished = False
+                    elif event == "placed":
+                        self._placed.add(record["part"])
+                        self._current = None
+                    elif event in ("pick", "align", "place"):
+                        self._current = record["part"]
+                    elif event == "end":
+                        self._finished = True
+            if valid < os.path.getsize(self._path):
+                with open(self._path, "r+b") as f:
+                    f.truncate(valid)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,124 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import bisect
+import collections
+import threading
+import time
+
+class PlacementMetrics():
+    """
+    Duration histograms of the phases of the pick and place cycle, per phase and nut type.
+
+    A phase is started when its commands are submitted and finished when the printer
+    acknowledged them, timestamps are taken from a monotonic clock. The most recent
+    transitions are kept as a timeline for debugging single placements.
+    """
+
+    BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0) # upper bounds in seconds
+    HISTORY = 1000 # transitions in the timeline
+
+    def __init__(self, clock=time.monotonic, buckets=BUCKETS, history=HISTORY):
+        self._clock = clock
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._started = {} # phase -> (nut, partnr, timestamp)
+        self._histograms = collections.OrderedDict() # (phase, nut) -> _Histogram
+        self._timeline = collections.deque(maxlen=history)
+
+    def start(self, phase, nut, partnr=None):
+        with self._lock:
+            now = self._clock()
+            self._started[phase] = (nut, partnr, now)
+            self._timeline.append((now, phase + " start", partnr))
+
+    # returns the duration of the phase in seconds, None if it was not started
+    def finish(self, phase):
+        with self._lock:
+            if phase not in self._started:
+                return None
+            nut, partnr, started = self._started.pop(phase)
+            now = self._clock()
+            self._timeline.append((now, phase + " done", partnr))
+            key = (phase, nut)
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram(self._buckets)
+            self._histograms[key].add(now - started)
+            return now - started
+
+    # transition without a duration, e.g. resuming the print job
+    def event(self, name, partnr=None):
+        with self._lock:
+            self._timeline.append((self._clock(), name, partnr))
+
+    # the placement was interrupted, the started phases are dropped without a duration
+    def abort(self, partnr=None):
+        with self._lock:
+            self._started = {}
+            self._timeline.append((self._clock(), "abort", partnr))
+
+    def reset(self):
+        with self._lock:
+            self._started = {}
+            self._histograms.clear()
+            self._timeline.clear()
+
+    def toDict(self):
+        with self._lock:
+            phases = []
+            for (phase, nut), histogram in self._histograms.items():
+                phases.append(dict(
+                    phase = phase,
+                    nut = nut,
+                    count = histogram.count,
+                    sum = histogram.sum,
+                    buckets = [dict(le=le, count=count) for le, count in histogram.cumulative()]
+                ))
+            return dict(
+                phases = phases,
+                timeline = [dict(time=timestamp, event=name, part=partnr) for timestamp, name, partnr in self._timeline]
+            )
+
+    # Prometheus text exposition format
+    def toPrometheus(self):
+        lines = ["# HELP octomagnetpnp_phase_seconds Duration of the pick and place phases",
+                 "# TYPE octomagnetpnp_phase_seconds histogram"]
+        with self._lock:
+            for (phase, nut), histogram in self._histograms.items():
+                labels = 'phase="%s",nut="%s"' % (_escape(phase), _escape(nut))
+                for le, count in histogram.cumulative():
+                    bound = "+Inf" if le is None else repr(float(le))
+                    lines.append('octomagnetpnp_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+                lines.append("octomagnetpnp_phase_seconds_sum{%s} %r" % (labels, histogram.sum))
+                lines.append("octomagnetpnp_phase_seconds_count{%s} %d" % (labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class _Histogram():
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1) # last bucket: above all bounds
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # (upper bound, number of values <= bound), bound None for +Inf
+    def cumulative(self):
+        total = 0
+        result = []
+        for le, count in zip(self._buckets + (None,), self._counts):
+            total += count
+            result.append((le, total))
+        return result
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
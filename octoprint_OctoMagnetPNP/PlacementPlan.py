@@ -0,0 +1,60 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import collections
+import hashlib
+
+# Compiled placement of a single part of nut type nut. box is the tray box number across all trays, tray and tray_box
+# the tray and the number of the box within it. pick, align and place are tuples of gcode commands,
+# tray_position and destination the [x, y, z] positions of the magnet, cycle_time the estimated
+# duration of moves and dwell times in seconds.
+PartPlan = collections.namedtuple("PartPlan", ["partnr", "nut", "box", "tray", "tray_box", "tray_position", "destination",
+                                               "travel_height", "pick", "align", "place", "cycle_time"])
+
+class PlacementPlan():
+    """
+    Immutable, precompiled gcode for the pick, align and place steps of every part of a job.
+    Compiled when a file is loaded or settings change, so placing a part only looks up the commands.
+    """
+
+    def __init__(self, parts, magnet_tool):
+        self._magnetTool = magnet_tool
+        self._order = tuple(part.partnr for part in parts)
+        self._parts = dict((part.partnr, part) for part in parts)
+        digest = hashlib.sha1(magnet_tool.encode("utf-8") + b"\n")
+        for part in parts:
+            for command in part.pick + part.align + part.place:
+                digest.update(command.encode("utf-8") + b"\n")
+        self._digest = digest.hexdigest()
+
+    def __contains__(self, partnr):
+        return partnr in self._parts
+
+    def getPart(self, partnr):
+        return self._parts[partnr]
+
+    def getPartIds(self):
+        return self._order
+
+    # tool change command selecting the magnet extruder
+    def getMagnetTool(self):
+        return self._magnetTool
+
+    def getCycleTime(self):
+        return sum(part.cycle_time for part in self._parts.values())
+
+    # digest over all commands, changes whenever the generated gcode changes
+    def getDigest(self):
+        return self._digest
+
+    def toDict(self):
+        return dict(
+            digest = self._digest,
+            magnetTool = self._magnetTool,
+            cycleTime = self.getCycleTime(),
+            parts = [self._parts[partnr]._asdict() for partnr in self._order]
+        )
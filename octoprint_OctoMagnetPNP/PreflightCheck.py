@@ -0,0 +1,116 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import collections
+import math
+
+# kind is "bed", "overlap" or "clearance", other is the second part of overlap and clearance problems
+PreflightIssue = collections.namedtuple("PreflightIssue", ["kind", "part", "other", "message"])
+
+# axis aligned box around the placed part: rotated shape at the destination, from destination z up to z + height
+Footprint = collections.namedtuple("Footprint", ["part", "min_x", "min_y", "max_x", "max_y", "bottom", "top"])
+
+class PreflightCheck():
+    """
+    Checks the destinations of all parts before a job is started.
+
+    Reports parts outside of the print volume, parts whose footprints overlap,
+    and parts placed next to an already placed part which sticks out above them,
+    so the magnet would hit it within clearance_radius. Footprints are kept in a
+    uniform grid, each part is only compared with the parts in nearby cells.
+    Destinations are taken from the part descriptions unless the calibrated
+    destinations the head actually moves to are given.
+    """
+
+    EPSILON = 1e-6
+
+    def __init__(self, clearance_radius=5.0, cell_size=None):
+        self._radius = float(clearance_radius)
+        self._cellSize = cell_size
+        self._size = cell_size
+
+    # bed: (min x, min y, max x, max y, max z) or None, cancelled() aborts the check and returns None
+    # destinations: dict partnr -> (x, y, z, additional rotation) or None
+    def check(self, smdparts, bed=None, cancelled=None, destinations=None):
+        footprints = [self.getFootprint(smdparts, partnr, destinations[partnr] if destinations is not None else None)
+                      for partnr in smdparts.getPartIds()]
+        issues = []
+        if bed is not None:
+            for footprint in footprints:
+                if (footprint.min_x < bed[0] or footprint.min_y < bed[1] or footprint.max_x > bed[2] or
+                        footprint.max_y > bed[3] or footprint.top > bed[4]):
+                    issues.append(PreflightIssue("bed", footprint.part, None,
+                                                 "Part " + str(footprint.part) + " is placed outside of the print volume"))
+
+        grid = self._buildGrid(footprints)
+        for i, footprint in enumerate(footprints):
+            if cancelled is not None and i % 1000 == 0 and cancelled():
+                return None
+            for j in self._neighbours(grid, footprint, self._radius):
+                if j == i:
+                    continue
+                other = footprints[j]
+                if j > i and _overlaps(footprint, other):
+                    issues.append(PreflightIssue("overlap", footprint.part, other.part,
+                                                 "Parts " + str(footprint.part) + " and " + str(other.part) + " overlap"))
+                elif (other.bottom <= footprint.bottom and other.top > footprint.top + self.EPSILON and
+                      not _overlaps(footprint, other) and _distance(footprint, other) < self._radius):
+                    issues.append(PreflightIssue("clearance", footprint.part, other.part,
+                                                 "Part " + str(other.part) + " is in the way when placing part " + str(footprint.part)))
+        return issues
+
+    @staticmethod
+    def getFootprint(smdparts, partnr, destination=None):
+        if destination is None:
+            destination = smdparts.getPartDestination(partnr)
+        x, y, z = destination[:3]
+        height = smdparts.getPartHeight(partnr) or 0.0
+        bounds = smdparts.getPartBoundingBox(partnr)
+        if bounds is None:
+            return Footprint(partnr, x, y, x, y, z, z + height)
+        angle = math.radians((smdparts.getPartRotation(partnr) or 0.0) + destination[3])
+        cos, sin = math.cos(angle), math.sin(angle)
+        corners = [(bx * cos - by * sin, bx * sin + by * cos) for bx in (bounds[0], bounds[2]) for by in (bounds[1], bounds[3])]
+        return Footprint(partnr, x + min(c[0] for c in corners), y + min(c[1] for c in corners),
+                         x + max(c[0] for c in corners), y + max(c[1] for c in corners), z, z + height)
+
+    def _buildGrid(self, footprints):
+        size = self._cellSize
+        if size is None:
+            extents = [max(f.max_x - f.min_x, f.max_y - f.min_y) for f in footprints]
+            size = max([1.0, self._radius] + ([sum(extents) / len(extents)] if extents else []))
+        self._size = size
+        grid = collections.defaultdict(list)
+        for i, footprint in enumerate(footprints):
+            for cell in self._cells(footprint, 0.0):
+                grid[cell].append(i)
+        return grid
+
+    def _cells(self, footprint, margin):
+        size = self._size
+        for cx in range(int(math.floor((footprint.min_x - margin) / size)), int(math.floor((footprint.max_x + margin) / size)) + 1):
+            for cy in range(int(math.floor((footprint.min_y - margin) / size)), int(math.floor((footprint.max_y + margin) / size)) + 1):
+                yield (cx, cy)
+
+    def _neighbours(self, grid, footprint, margin):
+        result = set()
+        for cell in self._cells(footprint, margin):
+            result.update(grid.get(cell, ()))
+        return sorted(result)
+
+
+def _overlaps(a, b):
+    epsilon = PreflightCheck.EPSILON
+    return (a.min_x < b.max_x - epsilon and b.min_x < a.max_x - epsilon and
+            a.min_y < b.max_y - epsilon and b.min_y < a.max_y - epsilon and
+            a.bottom < b.top - epsilon and b.bottom < a.top - epsilon)
+
+# horizontal distance between two footprints, 0 if they touch
+def _distance(a, b):
+    dx = max(0.0, b.min_x - a.max_x, a.min_x - b.max_x)
+    dy = max(0.0, b.min_y - a.max_y, a.min_y - b.max_y)
+    return math.hypot(dx, dy)
@@ -0,0 +1,166 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import collections
+import json
+
+from .CalibrationTransform import CalibrationTransform, CalibrationError
+
+# Immutable, typed copies of the plugin settings. JSON settings are parsed and validated when the
+# snapshot is built, lists of box configurations are tuples of dicts which must be treated as read-only.
+TraySettings = collections.namedtuple("TraySettings", ["x", "y", "z", "rows", "columns", "boxsize", "part_rotation_flat",
+                                                       "part_rotation_upright", "minimize_travel", "boxconfiguration",
+                                                       "additional_trays"])
+MagnetSettings = collections.namedtuple("MagnetSettings", ["x", "y", "extruder_nr", "grip_magnet_gcode", "release_magnet_gcode"])
+CacheSettings = collections.namedtuple("CacheSettings", ["prewarm"])
+SyncSettings = collections.namedtuple("SyncSettings", ["clearance_buffer"])
+UiSettings = collections.namedtuple("UiSettings", ["shape_tolerance"])
+ValidationSettings = collections.namedtuple("ValidationSettings", ["enabled", "clearance_radius"])
+MotionSettings = collections.namedtuple("MotionSettings", ["feedrate_xy", "feedrate_z", "feedrate_rotation", "settle_dwell",
+                                                           "grip_dwell", "release_dwell", "clearance", "overlap_rotation",
+                                                           "nut_profiles"])
+# transform is the CalibrationTransform fitted to the reference points
+CalibrationSettings = collections.namedtuple("CalibrationSettings", ["mode", "points", "version", "transform"])
+SettingsSnapshot = collections.namedtuple("SettingsSnapshot", ["tray", "magnet", "cache", "sync", "ui", "validation", "motion",
+                                                               "calibration"])
+
+GROUPS = SettingsSnapshot._fields
+MOTION_PARAMETERS = ("feedrate_xy", "feedrate_z", "feedrate_rotation", "settle_dwell", "grip_dwell", "release_dwell")
+TRAY_GEOMETRY = ("x", "y", "z", "rows", "columns", "boxsize")
+
+
+class SettingsError(ValueError):
+    pass
+
+
+# build a snapshot from a dict of setting groups (see get_settings_defaults), raises SettingsError for invalid values
+def buildSnapshot(data):
+    tray = data["tray"]
+    magnet = data["magnet"]
+    motion = data["motion"]
+    return SettingsSnapshot(
+        tray = TraySettings(
+            x = _number(tray, "tray.x", "x"),
+            y = _number(tray, "tray.y", "y"),
+            z = _number(tray, "tray.z", "z"),
+            rows = _number(tray, "tray.rows", "rows", int),
+            columns = _number(tray, "tray.columns", "columns", int, minimum=1),
+            boxsize = _number(tray, "tray.boxsize", "boxsize"),
+            part_rotation_flat = _number(tray, "tray.part_rotation_flat", "part_rotation_flat"),
+            part_rotation_upright = _number(tray, "tray.part_rotation_upright", "part_rotation_upright"),
+            minimize_travel = _boolean(tray.get("minimize_travel")),
+            boxconfiguration = _boxConfiguration(tray.get("boxconfiguration"), "tray.boxconfiguration"),
+            additional_trays = _additionalTrays(tray.get("additional_trays"))
+        ),
+        magnet = MagnetSettings(
+            x = _number(magnet, "magnet.x", "x"),
+            y = _number(magnet, "magnet.y", "y"),
+            extruder_nr = _number(magnet, "magnet.extruder_nr", "extruder_nr", int, minimum=0),
+            grip_magnet_gcode = tuple((magnet.get("grip_magnet_gcode") or "").splitlines()),
+            release_magnet_gcode = tuple((magnet.get("release_magnet_gcode") or "").splitlines())
+        ),
+        cache = CacheSettings(prewarm=_boolean(data["cache"].get("prewarm"))),
+        sync = SyncSettings(clearance_buffer=_boolean(data["sync"].get("clearance_buffer"))),
+        ui = UiSettings(shape_tolerance=_number(data["ui"], "ui.shape_tolerance", "shape_tolerance", minimum=0)),
+        validation = ValidationSettings(
+            enabled = _boolean(data["validation"].get("enabled")),
+            clearance_radius = _number(data["validation"], "validation.clearance_radius", "clearance_radius", minimum=0)
+        ),
+        motion = MotionSettings(
+            clearance = _number(motion, "motion.clearance", "clearance", minimum=0),
+            overlap_rotation = _boolean(motion.get("overlap_rotation")),
+            nut_profiles = _nutProfiles(motion.get("nut_profiles")),
+            **dict((name, _number(motion, "motion." + name, name, minimum=0)) for name in MOTION_PARAMETERS)
+        ),
+        calibration = _calibration(data["calibration"])
+    )
+
+
+def _number(values, path, key, convert=float, minimum=None):
+    try:
+        value = convert(float(values.get(key)))
+    except (TypeError, ValueError):
+        raise SettingsError(path + ": " + repr(values.get(key)) + " is not a number")
+    if minimum is not None and value < minimum:
+        raise SettingsError(path + ": must be at least " + str(minimum))
+    return value
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+def _json(value, path, expected):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value.strip() else expected()
+        except ValueError as e:
+            raise SettingsError(path + ": invalid JSON, " + str(e))
+    if value is None:
+        value = expected()
+    if not isinstance(value, expected):
+        raise SettingsError(path + ": must be a JSON " + ("array" if expected is list else "object"))
+    return value
+
+def _boxConfiguration(value, path):
+    boxes = _json(value, path, list)
+    for i, box in enumerate(boxes):
+        where = path + ", box " + str(i)
+        if not isinstance(box, dict):
+            raise SettingsError(where + ": must be an object")
+        for key in ("nut", "slot_orientation"):
+            if not box.get(key):
+                raise SettingsError(where + ": " + key + " is missing")
+        _number(box, where, "thread_size")
+        if "count" in box:
+            _number(box, where, "count", int, minimum=0)
+        for name in MOTION_PARAMETERS:
+            if name in box:
+                _number(box, where, name, minimum=0)
+    return tuple(boxes)
+
+def _additionalTrays(value):
+    trays = []
+    for i, tray in enumerate(_json(value, "tray.additional_trays", list)):
+        where = "tray.additional_trays, tray " + str(i + 1)
+        if not isinstance(tray, dict):
+            raise SettingsError(where + ": must be an object")
+        tray = dict(tray)
+        for key in TRAY_GEOMETRY:
+            if key in tray:
+                tray[key] = _number(tray, where, key, int if key in ("rows", "columns") else float)
+        if tray.get("columns", 1) < 1:
+            raise SettingsError(where + ": columns must be at least 1")
+        tray["boxconfiguration"] = _boxConfiguration(tray.get("boxconfiguration"), where + " boxconfiguration")
+        trays.append(tray)
+    return tuple(trays)
+
+def _calibration(values):
+    mode = values.get("mode") or "none"
+    points = []
+    for i, point in enumerate(_json(values.get("points"), "calibration.points", list)):
+        where = "calibration.points, point " + str(i + 1)
+        try:
+            points.append(((float(point["cad"][0]), float(point["cad"][1])), (float(point["bed"][0]), float(point["bed"][1]))))
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise SettingsError(where + ": must be an object with \"cad\" and \"bed\" coordinates [x, y]")
+    try:
+        transform = CalibrationTransform(mode, points)
+    except CalibrationError as e:
+        raise SettingsError("calibration: " + str(e))
+    return CalibrationSettings(mode=mode, points=tuple(points), version=_number(values, "calibration.version", "version", int, minimum=0),
+                               transform=transform)
+
+def _nutProfiles(value):
+    profiles = _json(value, "motion.nut_profiles", dict)
+    for nut, profile in profiles.items():
+        if not isinstance(profile, dict):
+            raise SettingsError("motion.nut_profiles, " + nut + ": must be an object")
+        for name in MOTION_PARAMETERS:
+            if name in profile:
+                _number(profile, "motion.nut_profiles, " + nut, name, minimum=0)
+    return profiles
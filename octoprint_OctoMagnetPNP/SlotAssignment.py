@@ -0,0 +1,174 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import collections
+import heapq
+import math
+
+# part to assign: destination is [x, y] or None, thread_size, nut and orientation as given in the part description
+SlotRequest = collections.namedtuple("SlotRequest", ["partnr", "thread_size", "nut", "orientation", "destination"])
+
+class SlotAssignment():
+    """
+    Assigns parts to tray boxes.
+
+    Boxes are indexed by (thread size, nut, orientation), a part fits every box
+    with the same key and a box with n nuts left is offered to n parts. Without
+    travel optimisation, parts get the boxes in tray order, like filling the tray
+    by hand. If the boxes belong to several trays, each part is taken from the
+    tray nearest to its destination which has a matching box left. With travel optimisation, each group of interchangeable boxes is
+    assigned by a minimum cost transportation on the distance between box and destination,
+    a box with n nuts left takes n parts.
+    """
+
+    def __init__(self, boxes, box_positions=None, stock=None, trays=None):
+        # boxes: list of box configurations, box_positions: [x, y] of every box, required for travel optimisation,
+        # stock: number of parts left in every box, one each if None, trays: tray number of every box
+        self._positions = box_positions
+        self._trayCenters = {}
+        if trays is not None and box_positions is not None:
+            members = collections.defaultdict(list)
+            for box, tray in enumerate(trays):
+                members[tray].append(box_positions[box])
+            for tray, positions in members.items():
+                self._trayCenters[tray] = [sum(p[0] for p in positions) / len(positions), sum(p[1] for p in positions) / len(positions)]
+        self._trays = trays
+        self._index = collections.defaultdict(list)
+        for i, box in enumerate(boxes):
+            count = 1 if stock is None else stock[i]
+            self._index[self.getKey(box.get("thread_size"), box.get("nut"), box.get("slot_orientation"))].extend([i] * count)
+
+    @staticmethod
+    def getKey(thread_size, nut, orientation):
+        try:
+            thread_size = float(thread_size)
+        except (TypeError, ValueError):
+            pass
+        return (thread_size, nut, orientation.lower() if orientation else orientation)
+
+    # number of parts which fit into the tray for each key
+    def getCapacity(self):
+        return dict((key, len(boxes)) for key, boxes in self._index.items())
+
+    # returns (dict partnr -> box nr, list of SlotRequests which did not fit into the tray)
+    def assign(self, requests, minimize_travel=False):
+        groups = collections.OrderedDict()
+        for request in requests:
+            groups.setdefault(self.getKey(request.thread_size, request.nut, request.orientation), []).append(request)
+
+        assignment = {}
+        unassigned = []
+        for key, group in groups.items():
+            boxes = self._index.get(key, [])
+            # surplus parts can never fit, parts are served in file order
+            unassigned.extend(group[len(boxes):])
+            group = group[:len(boxes)]
+            if minimize_travel and self._positions is not None and len(group) > 1:
+                # every box once, with the number of nuts left in it as capacity
+                capacity = collections.OrderedDict()
+                for box in boxes:
+                    capacity[box] = capacity.get(box, 0) + 1
+                columns = list(capacity)
+                cost = [[self._distance(request.destination, box) for box in columns] for request in group]
+                for request, column in zip(group, _minimumCostTransport(cost, list(capacity.values()))):
+                    assignment[request.partnr] = columns[column]
+            elif len(self._trayCenters) > 1:
+                slots = collections.OrderedDict()
+                for box in boxes:
+                    slots.setdefault(self._trays[box], collections.deque()).append(box)
+                for request in group:
+                    tray = min((tray for tray in slots if slots[tray]), key=lambda tray: self._trayDistance(request.destination, tray))
+                    assignment[request.partnr] = slots[tray].popleft()
+            else:
+                for request, box in zip(group, boxes):
+                    assignment[request.partnr] = box
+        order = dict((request.partnr, i) for i, request in enumerate(requests))
+        unassigned.sort(key=lambda request: order[request.partnr])
+        return assignment, unassigned
+
+    def _distance(self, destination, box):
+        return _distance(destination, self._positions[box])
+
+    def _trayDistance(self, destination, tray):
+        return _distance(destination, self._trayCenters[tray])
+
+
+def _distance(destination, position):
+    if destination is None:
+        return 0.0
+    return math.hypot(position[0] - destination[0], position[1] - destination[1])
+
+
+# Minimum cost transportation of rows (one unit each) to columns with capacity[j] units, by successive shortest
+# paths: each row is added along the cheapest path which may move previously assigned rows to other columns
+# (Dijkstra on reduced costs, with potentials). O(n (n + m) m log) for n rows and m distinct columns, so a box
+# holding many nuts is a single column. Returns the column assigned to each row with minimum total cost,
+# the capacities must add up to at least n.
+def _minimumCostTransport(cost, capacity):
+    n = len(cost)
+    m = len(capacity)
+    inf = float("inf")
+    rowPotential = [0.0] * n
+    columnPotential = [0.0] * m
+    result = [None] * n
+    members = [set() for j in range(m)] # rows assigned to each column
+    for source in range(n):
+        rowDistance = [inf] * n
+        columnDistance = [inf] * m
+        rowParent = [None] * n # column the row is reached from
+        columnParent = [None] * m # row the column is reached from
+        rowDistance[source] = 0.0
+        heap = [(0.0, 0, source)] # (distance, 0 = row / 1 = column, index)
+        rowsDone = [False] * n
+        columnsDone = [False] * m
+        target = None
+        while heap:
+            distance, kind, index = heapq.heappop(heap)
+            if kind == 0:
+                if rowsDone[index] or distance > rowDistance[index]:
+                    continue
+                rowsDone[index] = True
+                row = cost[index]
+                base = distance + rowPotential[index]
+                for j in range(m):
+                    if not columnsDone[j] and j != result[index]:
+                        candidate = base + row[j] - columnPotential[j]
+                        if candidate < columnDistance[j]:
+                            columnDistance[j] = candidate
+                            columnParent[j] = index
+                            heapq.heappush(heap, (candidate, 1, j))
+            else:
+                if columnsDone[index] or distance > columnDistance[index]:
+                    continue
+                columnsDone[index] = True
+                if len(members[index]) < capacity[index]:
+                    target = index
+                    break
+                # move an assigned row to another column
+                for i in members[index]:
+                    if not rowsDone[i]:
+                        candidate = distance + columnPotential[index] - cost[i][index] - rowPotential[i]
+                        if candidate < rowDistance[i]:
+                            rowDistance[i] = candidate
+                            rowParent[i] = index
+                            heapq.heappush(heap, (candidate, 0, i))
+        limit = columnDistance[target]
+        for i in range(n):
+            rowPotential[i] += min(rowDistance[i], limit)
+        for j in range(m):
+            columnPotential[j] += min(columnDistance[j], limit)
+        # augment along the path back to the source
+        column = target
+        while column is not None:
+            row = columnParent[column]
+            previous = result[row]
+            if previous is not None:
+                members[previous].discard(row)
+            members[column].add(row)
+            result[row] = column
+            column = rowParent[row] if row != source else None
+    return result
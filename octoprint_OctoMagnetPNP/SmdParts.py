@@ -7,21 +7,78 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 
 import xml.etree.ElementTree as ET
 
+from .PartShape import PartShape
+
+class SmdPart():
+    """
+    Parsed information on a single part, all numeric values are already converted.
+    Optional values which are not given in the XML description are None, except
+    the rotation which defaults to 0.
+    """
+    __slots__ = ("id", "name", "box", "height", "shape", "type", "threadSize", "orientation", "rotation", "destination")
+
+    def __init__(self, elem):
+        self.id = int(elem.get("id"))
+        self.name = elem.get("name")
+        self.box = _attribute(elem, "position", "box", int)
+        self.height = _attribute(elem, "size", "height", float)
+        self.shape = PartShape(elem.find("shape"))
+        self.type = _attribute(elem, "type", "identifier", str)
+        self.threadSize = _attribute(elem, "type", "thread_size", str)
+        self.orientation = _attribute(elem, "orientation", "orientation", str)
+        self.rotation = _attribute(elem, "rotation", "z", float) or 0.0
+        destination = elem.find("destination")
+        self.destination = (float(destination.get("x")), float(destination.get("y")), float(destination.get("z")), 0)
+
+
+# value of attribute in the child tag of a part, converted with convert. None if missing or invalid.
+def _attribute(elem, tag, attribute, convert):
+    child = elem.find(tag)
+    if child is None or child.get(attribute) is None:
+        return None
+    try:
+        return convert(child.get(attribute))
+    except ValueError:
+        return None
+
+
+# validator for text attributes
+def _nonEmpty(value):
+    if not value or not value.strip():
+        raise ValueError("empty value")
+    return value
+
+
 class SmdParts():
 
     def __init__(self):
         self._et = None
-        pass
-
-    def load(self, xmlstring):
-        self._et = ET.fromstring(xmlstring)
-        sane, msg = self._sanitize()
-        if not sane:
-            self.unload()
-        return sane, msg
+        self._ids = []
+        self._parts = {}
+
+    # load part information from an XML string or an already parsed root element
+    # sanitize can be skipped for data which has been sanitized before, e.g. from the part cache
+    def load(self, xml, sanitize=True):
+        if ET.iselement(xml):
+            self._et = xml
+        else:
+            self._et = ET.fromstring(xml)
+        if sanitize:
+            sane, msg = self._sanitize()
+            if not sane:
+                self.unload()
+                return sane, msg
+        self._buildIndex()
+        return True, ""
 
     def unload(self):
         self._et = None
+        self._ids = []
+        self._parts = {}
+
+    # serialized XML of the loaded (sanitized) part information
+    def dump(self):
+        return ET.tostring(self._et)
 
     def isFileLoaded(self):
         if self._et is not None:
@@ -30,57 +87,64 @@ class SmdParts():
             return False
 
     def getPartCount(self):
-        count = 0
-        for elem in self._et.findall("./part"):
-            count += 1
-        return count
+        return len(self._ids)
 
 
     # returns a list of all available parts
     def getPartIds(self):
-        result = []
-        for elem in self._et.findall("./part"):
-            result.append(int(elem.get("id")))
-        return result
+        return list(self._ids)
+
+    # returns the SmdPart record for partnr
+    def getPart(self, partnr):
+        return self._parts[partnr]
 
     #return the nr of the box this part is supposed to be in
     def getPartPosition(self, partnr):
-        return int(self._et.find("./part[@id='" + str(partnr) + "']/position").get("box"))
+        return self._parts[partnr].box
 
     def getPartName(self, partnr):
-        return self._et.find("./part[@id='" + str(partnr) + "']").get("name")
+        return self._parts[partnr].name
 
     def getPartHeight(self, partnr):
-        return float(self._et.find("./part[@id='" + str(partnr) + "']/size").get("height"))
+        return self._parts[partnr].height
 
+    # list of [x, y] points
     def getPartShape(self, partnr):
-        result = []
-        if(self._et.find("./part[@id='" + str(partnr) + "']/shape") is not None):
-            for elem in self._et.find("./part[@id='" + str(partnr) + "']/shape"):
-                result.append([float(elem.get("x")), float(elem.get("y"))])
-        return result
+        return self._parts[partnr].shape.toList()
+
+    # (min x, min y, max x, max y) of the shape, None for parts without shape
+    def getPartBoundingBox(self, partnr):
+        return self._parts[partnr].shape.getBoundingBox()
+
+    # shape simplified to tolerance (mm) for display
+    def getPartOutline(self, partnr, tolerance):
+        return self._parts[partnr].shape.getOutline(tolerance)
 
     def getPartType(self, partnr):
-        if(self._et.find("./part[@id='" + str(partnr) + "']/type") is not None):
-            return self._et.find("./part[@id='" + str(partnr) + "']/type").get("identifier")
+        return self._parts[partnr].type
 
     def getPartThreadSize(self, partnr):
-        if(self._et.find("./part[@id='" + str(partnr) + "']/type") is not None):
-            return self._et.find("./part[@id='" + str(partnr) + "']/type").get("thread_size")
+        return self._parts[partnr].threadSize
 
     # Upright, Flat
     def getPartOrientation(self, partnr):
-        return self._et.find("./part[@id='" + str(partnr) + "']/orientation").get("orientation")
+        return self._parts[partnr].orientation
 
     def getPartRotation(self, partnr):
-        return float(self._et.find("./part[@id='" + str(partnr) + "']/rotation").get("z"))
+        return self._parts[partnr].rotation
 
     def getPartDestination(self, partnr):
-        x = float(self._et.find("./part[@id='" + str(partnr) + "']/destination").get("x"))
-        y = float(self._et.find("./part[@id='" + str(partnr) + "']/destination").get("y"))
-        z = float(self._et.find("./part[@id='" + str(partnr) + "']/destination").get("z"))
-        orientation = 0 #float(self._et.find("./part[@id='" + str(partnr) + "']/destination").get("orientation"))
-        return [x, y, z, orientation]
+        return list(self._parts[partnr].destination)
+
+    # parse all parts once, getters are simple lookups afterwards
+    def _buildIndex(self):
+        self._ids = []
+        self._parts = {}
+        for elem in self._et.findall("./part"):
+            part = SmdPart(elem)
+            self._ids.append(part.id)
+            # the first part wins for duplicate ids, like the former XPath lookups
+            self._parts.setdefault(part.id, part)
 
     def _sanitize(self):
         result = True
@@ -121,6 +185,13 @@ class SmdParts():
                 # destination
                 if result:
                     result, msg = self._sanitizeTag(part, "destination", ["x", "y", "z"], float)
+                # optional tags, parts without type or orientation get no tray box
+                if result:
+                    result, msg = self._sanitizeOptionalTag(part, "rotation", ["z"], float)
+                if result:
+                    result, msg = self._sanitizeOptionalTag(part, "type", ["identifier", "thread_size"], _nonEmpty)
+                if result:
+                    result, msg = self._sanitizeOptionalTag(part, "orientation", ["orientation"], _nonEmpty)
 
         return result, msg
 
@@ -139,6 +210,13 @@ class SmdParts():
         return result, msg
 
 
+    # like _sanitizeTag, but the tag may be missing
+    def _sanitizeOptionalTag(self, part, tag, attributes, validate):
+        if part.find(tag) is None:
+            return True, ""
+        return self._sanitizeTag(part, tag, attributes, validate)
+
+
     def _sanitizeAttribute(self, part, elem, attributes, validate):
         result = True
         msg = ""
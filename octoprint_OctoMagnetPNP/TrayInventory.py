@@ -0,0 +1,124 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import json
+import os
+import threading
+
+class TrayInventory():
+    """
+    Persistent count of the nuts left in each tray box.
+
+    A box holds "count" nuts (key of its entry in the box configuration, 1 if
+    missing). Consumed nuts are stored in the plugin data folder, so several jobs
+    can draw from the same tray. Boxes whose configuration changed are considered
+    refilled. Every change is written atomically. Consumed nuts are written by a
+    background thread, so placing a part never waits for the disk.
+    """
+
+    FILE_NAME = "inventory.json"
+    CONFIG_KEYS = ("thread_size", "nut", "slot_orientation", "count")
+
+    def __init__(self, folder):
+        self._path = os.path.join(folder, self.FILE_NAME)
+        self._lock = threading.Lock() # boxes and changed flag
+        self._writeLock = threading.Lock() # the inventory file
+        # one dict(box, capacity, consumed) per box, box is the configuration of the box
+        self._boxes = []
+        self._changed = False # not written yet
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._read()
+
+    # synchronize with the box configuration, keeps the consumption of unchanged boxes
+    def configure(self, boxes):
+        with self._lock:
+            inventory = []
+            for i, box in enumerate(boxes):
+                config = dict((key, box.get(key)) for key in self.CONFIG_KEYS)
+                if i < len(self._boxes) and self._boxes[i]["box"] == config:
+                    inventory.append(self._boxes[i])
+                else:
+                    inventory.append(dict(box=config, capacity=int(box.get("count", 1)), consumed=0))
+            if inventory == self._boxes:
+                return
+            self._boxes = inventory
+            self._changed = True
+        self.flush()
+
+    # nuts left in every box
+    def getStock(self):
+        with self._lock:
+            return [max(0, entry["capacity"] - entry["consumed"]) for entry in self._boxes]
+
+    def getRemaining(self, box):
+        with self._lock:
+            if not 0 <= box < len(self._boxes):
+                return 0
+            entry = self._boxes[box]
+            return max(0, entry["capacity"] - entry["consumed"])
+
+    def consume(self, box, count=1):
+        with self._lock:
+            if not 0 <= box < len(self._boxes):
+                return
+            self._boxes[box]["consumed"] += count
+            self._changed = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="OctoMagnetPNP inventory")
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    # refill a single box or the whole tray
+    def refill(self, box=None):
+        with self._lock:
+            for i, entry in enumerate(self._boxes):
+                if box is None or i == box:
+                    entry["consumed"] = 0
+            self._changed = True
+        self.flush()
+
+    # write the inventory now if it changed
+    def flush(self):
+        with self._writeLock:
+            with self._lock:
+                if not self._changed:
+                    return
+                data = json.dumps(dict(boxes=self._boxes))
+                self._changed = False
+            self._write(data)
+
+    def toDict(self):
+        with self._lock:
+            return dict(boxes=[dict(capacity=entry["capacity"], consumed=entry["consumed"]) for entry in self._boxes])
+
+    def _read(self):
+        try:
+            with open(self._path, "r") as f:
+                self._boxes = json.load(f)["boxes"]
+        except (IOError, OSError, ValueError, KeyError):
+            self._boxes = []
+
+    # background writer for consumed nuts
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    # write via a temporary file, the inventory is never left in a half written state
+    def _write(self, data):
+        tmp = self._path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
@@ -0,0 +1,74 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import json
+
+class TrayLayout():
+    """
+    Precomputed position table of the boxes of all trays.
+
+    The first tray is defined by the tray settings, additional trays (e.g. a tray
+    stack or trays around the bed) by dicts with the same keys: x, y, z, rows,
+    columns, boxsize and boxconfiguration. Missing geometry is taken from the first
+    tray. Boxes are numbered consecutively across all trays, starting with the
+    boxes of the first tray, so box numbers of the first tray never change.
+    """
+
+    GEOMETRY = ("x", "y", "z", "rows", "columns", "boxsize")
+
+    def __init__(self, tray, additional_trays=()):
+        self._boxes = []
+        self._positions = []
+        self._trays = []
+        self._trayBoxes = []
+        self._trayZ = []
+        for number, settings in enumerate([tray] + list(additional_trays)):
+            geometry = dict((key, settings.get(key, tray.get(key))) for key in self.GEOMETRY)
+            config = settings.get("boxconfiguration", [])
+            if not isinstance(config, (list, tuple)):
+                config = json.loads(config)
+
+            columns = int(geometry["columns"])
+            boxsize = float(geometry["boxsize"])
+            z = float(geometry["z"])
+            self._trayZ.append(z)
+            for i, box in enumerate(config):
+                row = i // columns
+                col = i % columns
+                self._boxes.append(box)
+                self._positions.append((col * boxsize + float(geometry["x"]), row * boxsize + float(geometry["y"]), z))
+                self._trays.append(number)
+                self._trayBoxes.append(i)
+
+    # box configurations of all trays
+    def getBoxes(self):
+        return self._boxes
+
+    # [x, y, z] of the center of a box
+    def getPosition(self, box):
+        return list(self._positions[box])
+
+    def getPositions(self):
+        return self._positions
+
+    # tray number of every box
+    def getTrays(self):
+        return self._trays
+
+    def getTray(self, box):
+        return self._trays[box]
+
+    # number of a box within its tray
+    def getTrayBox(self, box):
+        return self._trayBoxes[box]
+
+    def getTrayCount(self):
+        return len(self._trayZ)
+
+    # height of the highest tray
+    def getMaxZ(self):
+        return max(self._trayZ)
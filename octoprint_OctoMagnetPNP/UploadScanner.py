@@ -0,0 +1,37 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import octoprint.filemanager.util
+
+from .XmlExtractor import XmlExtractor
+
+class UploadScanner(octoprint.filemanager.util.LineProcessorStream):
+    """
+    Extracts the part description while an uploaded file is written to disk.
+
+    Every line of the upload passes through unchanged. Lines containing a tag are
+    fed to an XmlExtractor until the root element is closed. When the stream is
+    closed, callback(root element or None, error message, digest) is called once.
+    """
+
+    def __init__(self, input_stream, callback):
+        octoprint.filemanager.util.LineProcessorStream.__init__(self, input_stream)
+        self._extractor = XmlExtractor()
+        self._callback = callback
+
+    def process_line(self, line):
+        if b"<" in line and not self._extractor.isDone():
+            self._extractor.feed(line if line.endswith(b"\n") else line + b"\n")
+        return line
+
+    def close(self):
+        callback = self._callback
+        self._callback = None
+        octoprint.filemanager.util.LineProcessorStream.close(self)
+        if callback is not None:
+            root, msg = self._extractor.close()
+            callback(root, msg, self._extractor.getDigest())
@@ -0,0 +1,123 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Florens Wasserfall <wasserfall@kalanka.de> Arne Büngener <arne.buengener@googlemail.com>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+
+class XmlExtractor():
+    """
+    Incrementally extracts the commented XML part description from gcode.
+
+    Data is fed as raw bytes in arbitrary chunks. Only comment lines (starting
+    with ";") containing a tag are passed on to a pull parser, so memory use
+    depends on the size of the XML block and not on the size of the gcode file.
+    Once the root element is closed, all further input is ignored.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._remainder = b""
+        self._root = None
+        self._depth = 0
+        self._started = False
+        self._wrapped = False
+        self._done = False
+        self._msg = ""
+        self._digest = hashlib.sha1()
+
+    # extract the XML block from the gcode file at path, returns (root element or None, error message)
+    # progress(bytes_read, file_size) is called after every chunk, a true return value of cancelled() aborts the scan
+    def readFile(self, path, chunk_size=CHUNK_SIZE, progress=None, cancelled=None):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            position = 0
+            while not self.isDone():
+                if cancelled is not None and cancelled():
+                    return None, ""
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                self.feed(chunk)
+                position += len(chunk)
+                if progress is not None:
+                    progress(position, size)
+        return self.close()
+
+    # True as soon as the root element has been closed or a parsing error occurred
+    def isDone(self):
+        return self._done
+
+    # hex digest over the XML block, identifies the part description independent of the surrounding gcode
+    def getDigest(self):
+        return self._digest.hexdigest()
+
+    def feed(self, data):
+        if self._done:
+            return
+        buf = self._remainder + data if self._remainder else data
+        end = buf.rfind(b"\n")
+        if end == -1:
+            self._remainder = buf
+            return
+        self._remainder = buf[end+1:]
+        self._scan(buf, end)
+
+    # finish extraction, returns (root element or None, error message)
+    def close(self):
+        if not self._done and self._remainder:
+            buf = self._remainder + b"\n"
+            self._remainder = b""
+            self._scan(buf, len(buf) - 1)
+        if self._started and not self._done:
+            if self._wrapped:
+                self._feedXml(b"</object>")
+            if not self._done and not self._msg:
+                self._msg = "unexpected end of XML data"
+        if self._msg:
+            return None, self._msg
+        return self._root, ""
+
+    # find all comment lines containing a tag in buf[:end]. buf[end] must be a line break.
+    def _scan(self, buf, end):
+        pos = buf.find(b"<", 0, end)
+        while pos != -1 and not self._done:
+            start = buf.rfind(b"\n", 0, pos) + 1
+            stop = buf.find(b"\n", pos, end + 1)
+            line = buf[start:stop]
+            if line.lstrip().startswith(b";"):
+                first = line.find(b"<")
+                last = line.rfind(b">")
+                if last > first:
+                    self._feedXml(line[first:last+1])
+            pos = buf.find(b"<", stop, end)
+
+    def _feedXml(self, fragment):
+        if not self._started:
+            self._started = True
+            #check for root node existence
+            if not fragment.startswith(b"<object"):
+                self._wrapped = True
+                fragment = b"<object name=\"defaultpart\">\n" + fragment
+        self._digest.update(fragment + b"\n")
+        try:
+            self._parser.feed(fragment + b"\n")
+            for event, elem in self._parser.read_events():
+                if event == "start":
+                    if self._root is None:
+                        self._root = elem
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._done = True
+                        break
+        except ET.ParseError as e:
+            self._msg = str(e)
+            self._done = True
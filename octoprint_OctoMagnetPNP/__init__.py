@@ -22,6 +22,7 @@ from __future__ import absolute_import
 
 
 import octoprint.plugin
+import flask
 import re
 from subprocess import call
 import os
@@ -30,8 +31,22 @@ import datetime
 import base64
 import shutil
 import json
+import threading
+import hashlib
+import collections
 
 from .SmdParts import SmdParts
+from .XmlExtractor import XmlExtractor
+from .PartCache import PartCache
+from .MotionProfile import MotionProfile, MoveSequence, formatCommand
+from .PlacementPlan import PlacementPlan, PartPlan
+from .SlotAssignment import SlotAssignment, SlotRequest
+from .TrayInventory import TrayInventory
+from .TrayLayout import TrayLayout
+from .PlacementMetrics import PlacementMetrics
+from .PreflightCheck import PreflightCheck
+from .PlacementJournal import PlacementJournal
+from .SettingsSnapshot import buildSnapshot, SettingsError, GROUPS
 
 __plugin_name__ = "OctoMagnetPNP"
 
@@ -44,11 +59,13 @@ def __plugin_load__():
     __plugin_implementation__ = octomagnetpnp
 
     global __plugin_hooks__
-    __plugin_hooks__ = {'octoprint.comm.protocol.gcode.sending': octomagnetpnp.hook_gcode_sending, 'octoprint.comm.protocol.gcode.queuing': octomagnetpnp.hook_gcode_queuing}
+    __plugin_hooks__ = {'octoprint.comm.protocol.gcode.sending': octomagnetpnp.hook_gcode_sending, 'octoprint.comm.protocol.gcode.queuing': octomagnetpnp.hook_gcode_queuing,
+                        'octoprint.filemanager.preprocessor': octomagnetpnp.hook_file_preprocessor}
 
 
 
 class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
+            octoprint.plugin.ShutdownPlugin,
             octoprint.plugin.TemplatePlugin,
             octoprint.plugin.EventHandlerPlugin,
             octoprint.plugin.SettingsPlugin,
@@ -64,22 +81,82 @@ class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
 
     FEEDRATE = 4000.000
 
+    SYNC_COMMAND = "M362 OctoMagnetPNP"
+    DONE_COMMAND = "M362 OctoMagnetPNP done" # acknowledges the last step of a batch without advancing the state machine
+    PART_PARAMETER = re.compile(r"P(\d+)")
+
+    EXTRACTION_TIMEOUT = 120 # max. seconds a M361 waits for part information of the selected file
+    EXTRACTION_PROGRESS_STEP = 10 # percent
+    PREFLIGHT_LOG_LIMIT = 20 # problems logged individually
+    METADATA_KEY = "OctoMagnetPNP" # additional metadata of uploaded files, see _storeUploadParts()
+    GCODE_EXTENSIONS = (".gcode", ".gco", ".g")
+
     smdparts = SmdParts()
     partPositions = {}
 
     def __init__(self):
+        # state machine, changed by the queuing and the sending thread. Reentrant, since _printer.commands()
+        # passes the injected commands through the queuing hook in the calling thread.
+        self._stateLock = threading.RLock()
         self._state = self.STATE_NONE
         self._currentPart = 0
+        self._batch = []
+        self._pending = collections.deque() # parts of M361 commands received during a placement
+        self._placing = None # (part, tray box) whose place step has been sent, booked when the printer finished it
+        self._skipParts = frozenset() # parts already placed by an interrupted job which is resumed
+        self._placedBoxes = {} # parts placed since the file was loaded or the job started -> their tray box
+        self._placedTop = None # height of the highest of those parts
+        self._printZ = None # height of the print when the current batch started, None if unknown
+        self._headZ = None # height at which the last placement left the head
+        self._partPlan = None # PartPlan of the part being placed, see _getClearanceTop()
+        self._filePath = None
+        self._uploads = {} # path -> part information scanned during the upload, until the file has been added
+        self._uploadsLock = threading.Lock()
+        self._magnetSelected = False
+        self._pausedPrint = False
+        self._config = None
+        self._configError = None # why the stored settings are invalid, if there is no valid snapshot
+        self._jobLock = threading.RLock() # serializes preparing the job, held while the loaded part information is swapped
+        self._jobOutdated = False # settings, tray or file changed during a placement, see _prepareJob()
+        self._motionProfile = None
+        self._trayLayout = None
+        self._destinations = None
+        self._plan = None
+        self._partTable = None
+        self._preflightIssues = []
         self._helper_was_paused = False
+        self._metrics = PlacementMetrics()
+
+        # background extraction of part information, see _startExtraction()
+        self._extractionLock = threading.Lock()
+        self._extractionCancel = threading.Event()
+        self._partsLoaded = threading.Event()
+        self._partsLoaded.set()
 
         # store callback to send result of an image capture request back to caller
         self._helper_callback = None
 
 
+    def initialize(self):
+        self._partCache = PartCache(os.path.join(self.get_plugin_data_folder(), "partcache"))
+        self._inventory = TrayInventory(self.get_plugin_data_folder())
+        self._journal = PlacementJournal(self.get_plugin_data_folder())
+
     def on_after_startup(self):
         #used for communication to UI
         self._pluginManager = octoprint.plugin.plugin_manager()
 
+        config = self._getConfig()
+        if config is not None and config.cache.prewarm:
+            worker = threading.Thread(target=self._prewarmPartCache, name="OctoMagnetPNP part cache")
+            worker.daemon = True
+            worker.start()
+
+
+    def on_shutdown(self):
+        self._journal.flush()
+        self._inventory.flush()
+
 
     def get_settings_defaults(self):
         return {
@@ -92,6 +169,8 @@ class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
                 "boxsize": 10,
                 "part_rotation_flat": 0,
                 "part_rotation_upright": 0,
+                "minimize_travel": False,
+                "additional_trays": "[]",
                 "boxconfiguration": "[ {\"thread_size\": \"2\", \"nut\": \"hexnut\", \"slot_orientation\": \"upright\"},   {\"thread_size\": \"2.5\", \"nut\": \"hexnut\", \"slot_orientation\": \"upright\"},   {\"thread_size\": \"3\", \"nut\": \"hexnut\", \"slot_orientation\": \"flat\"},   {\"thread_size\": \"8\", \"nut\": \"hexnut\", \"slot_orientation\": \"upright\"},   {\"thread_size\": \"8\", \"nut\": \"hexnut\", \"slot_orientation\": \"flat\"},   {\"thread_size\": \"3\", \"nut\": \"squarenut\", \"slot_orientation\": \"upright\"},   {\"thread_size\": \"10\", \"nut\": \"squarenut\", \"slot_orientation\": \"flat\"},   {\"thread_size\": \"8\", \"nut\": \"squarenut\", \"slot_orientation\": \"upright\"},   {\"thread_size\": \"6\", \"nut\": \"squarenut\", \"slot_orientation\": \"flat\"},   {\"thread_size\": \"4\", \"nut\": \"squarenut\", \"slot_orientation\": \"upright\"} ]"
             },
             "magnet": {
@@ -100,9 +179,154 @@ class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
                 "extruder_nr": 2,
                 "grip_magnet_gcode": "M42 P48 S255",
                 "release_magnet_gcode": "M42 P48 S0",
+            },
+            "cache": {
+                "prewarm": True
+            },
+            "ui": {
+                "shape_tolerance": 0.05
+            },
+            "validation": {
+                "enabled": True,
+                "clearance_radius": 5
+            },
+            "sync": {
+                "clearance_buffer": False
+            },
+            "calibration": {
+                "mode": "none",
+                "points": "[]",
+                "version": 0
+            },
+            "motion": {
+                "feedrate_xy": self.FEEDRATE,
+                "feedrate_z": 1000,
+                "feedrate_rotation": 1000,
+                "settle_dwell": 500,
+                "grip_dwell": 1000,
+                "release_dwell": 1000,
+                "clearance": 3,
+                "overlap_rotation": False,
+                "nut_profiles": "{}"
             }
         }
 
+    def on_settings_save(self, data):
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        # invalid settings are reported here and the previous snapshot stays in use
+        config = self._buildConfig()
+        if config is None:
+            return
+        # a new calibration version invalidates the calibrated destinations and the part table
+        previous = self._config.calibration if self._config is not None else None
+        if previous is not None and (config.calibration.mode, config.calibration.points) != (previous.mode, previous.points):
+            version = max(config.calibration.version, previous.version) + 1
+            self._settings.set(["calibration", "version"], version)
+            config = config._replace(calibration=config.calibration._replace(version=version))
+            self._logger.info("Calibration version %d (%s), residual error %.3f mm", version, config.calibration.mode,
+                              config.calibration.transform.residual)
+        self._config = config
+        if self.smdparts.isFileLoaded():
+            self._prepareJob()
+
+    # Typed snapshot of the settings, built on first use and replaced as a whole when the settings are saved,
+    # so a placement never sees half of a settings change. None if the stored settings are invalid: then no plan
+    # is compiled and M361 commands are rejected until valid settings are saved, see _configError.
+    def _getConfig(self):
+        if self._config is None and self._configError is None:
+            self._config = self._buildConfig()
+        return self._config
+
+    # snapshot of the current settings, None if they are invalid
+    def _buildConfig(self):
+        try:
+            config = buildSnapshot(dict((group, self._settings.get([group], merged=True)) for group in GROUPS))
+        except SettingsError as e:
+            self._logger.info("ERROR, invalid settings: " + str(e))
+            self._updateUI("ERROR", "Invalid settings, " + str(e))
+            if self._config is None:
+                self._configError = str(e)
+            return None
+        self._configError = None
+        return config
+
+    # GET /api/plugin/OctoMagnetPNP returns the compiled placement plan of the loaded file
+    def on_api_get(self, request):
+        plan = self._plan
+        config = self._getConfig()
+        calibration = None
+        if config is not None:
+            transform = config.calibration.transform
+            calibration = dict(mode=config.calibration.mode, version=config.calibration.version,
+                               residual=transform.residual, matrix=transform.toList())
+        return flask.jsonify(plan=plan.toDict() if plan is not None else None, inventory=self._inventory.toDict(),
+                             calibration=calibration, settingsError=self._configError,
+                             preflight=[issue._asdict() for issue in self._preflightIssues], pending=len(self._pending),
+                             journal=self._journal.getUnfinished(), skipped=sorted(self._skipParts))
+
+    # GET /plugin/OctoMagnetPNP/metrics returns the phase durations as JSON
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def getMetrics(self):
+        return flask.jsonify(self._metrics.toDict())
+
+    # GET /plugin/OctoMagnetPNP/metrics/prometheus returns the phase durations in the Prometheus text format
+    @octoprint.plugin.BlueprintPlugin.route("/metrics/prometheus", methods=["GET"])
+    def getPrometheusMetrics(self):
+        return flask.Response(self._metrics.toPrometheus(), mimetype="text/plain; version=0.0.4")
+
+    # GET /plugin/OctoMagnetPNP/parts returns the part table of the loaded file, versioned by its ETag
+    @octoprint.plugin.BlueprintPlugin.route("/parts", methods=["GET"])
+    def getPartTable(self):
+        table = self._partTable
+        if table is None:
+            table = self._partTable = self._buildPartTable(self._plan)
+        etag, body = table
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in flask.request.headers.get("If-None-Match", ""):
+            return flask.Response(status=304, headers=headers)
+        return flask.Response(body, mimetype="application/json", headers=headers)
+
+    # GET /plugin/OctoMagnetPNP/files returns part count and tray fit of all uploaded files, from their metadata
+    @octoprint.plugin.BlueprintPlugin.route("/files", methods=["GET"])
+    def getFiles(self):
+        files = {}
+        def collect(entries):
+            for entry in entries.values():
+                if entry.get("type") == "folder":
+                    collect(entry.get("children", {}))
+                elif entry.get("path"):
+                    metadata = self._file_manager.get_additional_metadata("local", entry["path"], self.METADATA_KEY)
+                    if metadata:
+                        files[entry["path"]] = dict((key, metadata.get(key)) for key in ("parts", "fits", "verdict", "error"))
+        collect(self._file_manager.list_files("local", recursive=True).get("local", {}))
+        return flask.jsonify(files=files)
+
+    def get_api_commands(self):
+        return dict(
+            refill=[],
+            reset_metrics=[],
+            resume=[],
+            discard_journal=[]
+        )
+
+    # POST /api/plugin/OctoMagnetPNP {"command": "refill", "box": n} refills box n or the whole tray
+    # {"command": "resume"} skips the parts placed by the interrupted job of the selected file
+    def on_api_command(self, command, data):
+        if command == "refill":
+            self._inventory.refill(data.get("box"))
+            self._logger.info("Refilled tray box " + str(data["box"]) if data.get("box") is not None else "Refilled tray")
+            if self.smdparts.isFileLoaded():
+                self._prepareJob()
+        elif command == "reset_metrics":
+            self._metrics.reset()
+        elif command == "resume":
+            self._resumeJob()
+        elif command == "discard_journal":
+            self._journal.discard()
+            self._skipParts = frozenset()
+            if self.smdparts.isFileLoaded():
+                self._prepareJob()
+
     def get_template_configs(self):
         return [
             dict(type="tab", template="OctoMagnetPNP_tab.jinja2", custom_bindings=True),
@@ -122,63 +346,375 @@ class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
         #extraxt part informations from inline xmly
         if event == "FileSelected":
             self._currentPart = None
-            xml = "";
-            f = open(payload.get("file"), 'r')
-            for line in f:
-                expression = re.search("<.*>", line)
-                if expression:
-                    xml += expression.group() + "\n"
-            if xml:
-                #check for root node existence
-                if not re.search("<object.*>", xml.splitlines()[0]):
-                    xml = "<object name=\"defaultpart\">\n" + xml + "\n</object>"
-
-                #parse xml data
-                sane, msg = self.smdparts.load(xml)
+            self._startExtraction(payload.get("file"), self._getUploadMetadata(payload.get("origin"), payload.get("path")))
+
+        # part information of an upload has been scanned by the preprocessor hook
+        if event == "FileAdded" and payload.get("storage") == "local":
+            self._storeUploadParts(payload.get("path"))
+
+        # make sure the tray holds all nuts of the job before anything is printed
+        if event == "PrintStarted" and self.smdparts.isFileLoaded():
+            self._checkInventory()
+            if not self._skipParts:
+                self._journal.start(self._filePath)
+
+        if event == "PrintDone":
+            self._journal.finish()
+            self._skipParts = frozenset()
+
+        # a placement interrupted by the end of the job or the connection is never continued
+        if event in ("PrintFailed", "PrintCancelled", "Disconnected", "Connected"):
+            self._abortPlacement(event)
+
+        # the placed parts of an interrupted job can be skipped when it is printed again
+        if event in ("PrintFailed", "PrintCancelled", "Connected"):
+            self._journal.flush()
+            self._offerResume()
+
+        if event == "PrintDone":
+            with self._stateLock:
+                # queued M361 commands belong to the job
+                if self._pending:
+                    self._logger.info("Job ended, discarding %d queued M361 commands", len(self._pending))
+                    self._pending.clear()
+                    self._updateUI("QUEUE", 0)
+
+                # job ended directly after a M361, switch back to primary extruder
+                if self._magnetSelected and self._state == self.STATE_NONE:
+                    self._magnetSelected = False
+                    self._printer.commands("T0")
+
+    # Reset the state machine after the job or the connection ended during a placement, the sync commands
+    # which would advance it are lost. The batch and the queued M361 commands are dropped, a part whose
+    # place step was not acknowledged is not booked. The job is prepared again if it changed meanwhile.
+    def _abortPlacement(self, event):
+        with self._stateLock:
+            if self._state != self.STATE_NONE:
+                self._logger.info("%s while placing part %s, placement aborted", event, self._currentPart)
+                self._updateUI("ERROR", "Placement of part " + str(self._currentPart) + " aborted: " + event)
+                self._metrics.abort(self._currentPart)
+            if self._pending:
+                self._logger.info("Discarding %d queued M361 commands", len(self._pending))
+                self._pending.clear()
+                self._updateUI("QUEUE", 0)
+            self._state = self.STATE_NONE
+            self._batch = []
+            self._placing = None
+            self._partPlan = None
+            magnetSelected = self._magnetSelected
+            self._magnetSelected = False
+            # job ended during or directly after a M361, switch back to primary extruder
+            if magnetSelected and event in ("PrintFailed", "PrintCancelled"):
+                self._printer.commands("T0")
+        if self._jobOutdated:
+            self._prepareJob()
+
+    # scan the selected file in a background thread, a scan which is still running for a previously selected file is cancelled
+    # metadata is the part information stored when the file was uploaded, if any
+    def _startExtraction(self, path, metadata=None):
+        with self._extractionLock:
+            if path != self._filePath:
+                self._skipParts = frozenset()
+            self._filePath = path
+            self._extractionCancel.set()
+            self._extractionCancel = threading.Event()
+            self._partsLoaded = threading.Event()
+            worker = threading.Thread(target=self._extractParts,
+                                      args=(path, self._extractionCancel, self._partsLoaded, metadata),
+                                      name="OctoMagnetPNP part extraction")
+            worker.daemon = True
+            worker.start()
+
+    def _extractParts(self, path, cancel, loaded, metadata=None):
+        try:
+            reported = -1
+            def progress(position, size):
+                nonlocal reported
+                percent = 100 * position // size if size else 100
+                percent -= percent % self.EXTRACTION_PROGRESS_STEP
+                if percent > reported and not cancel.is_set():
+                    reported = percent
+                    self._updateUI("INFO", "Scanning file for part information: " + str(percent) + "%")
+
+            smdparts = SmdParts()
+            sane, msg = self._loadParts(smdparts, path, progress, cancel.is_set, metadata)
+
+            with self._extractionLock, self._jobLock:
+                if cancel.is_set():
+                    return
+                self._preflightIssues = []
+                self._placedBoxes = {}
+                self._placedTop = None
                 if sane:
-                    #TODO: validate part informations against tray
-                    self._logger.info("Extracted information on %d parts from gcode file %s", self.smdparts.getPartCount(), payload.get("file"))
-                    self._updateUI("FILE", "")
-                else:
+                    self.smdparts = smdparts
+                    self._logger.info("Extracted information on %d parts from gcode file %s", self.smdparts.getPartCount(), path)
+                    self._prepareJob()
+                    self._offerResume()
+                elif msg:
+                    self.smdparts.unload()
                     self._logger.info("XML parsing error: " + msg)
                     self._updateUI("ERROR", "XML parsing error: " + msg)
-            else:
-                #gcode file contains no part information -> clear smdpart object
-                self.smdparts.unload()
-                self._updateUI("FILE", "")
-
+                    self._prepareJob()
+                else:
+                    #gcode file contains no part information -> clear smdpart object
+                    self.smdparts.unload()
+                    self._prepareJob()
+            # parts are ready for placement, M361 and the print start don't wait for the pre-flight check
+            loaded.set()
+
+            config = self._getConfig()
+            if sane and config is not None and config.validation.enabled:
+                self._checkDestinations(smdparts, cancel)
+        except Exception:
+            self._logger.exception("Extracting part information from %s failed", path)
+            self._updateUI("ERROR", "Could not read part information from file")
+        finally:
+            loaded.set()
+
+    # pre-flight check of the calibrated part destinations, runs in the extraction thread after the part information is loaded
+    def _checkDestinations(self, smdparts, cancel):
+        start = time.time()
+        with self._jobLock:
+            # a newer file replaced the parts
+            if smdparts is not self.smdparts:
+                return
+            destinations = self._getDestinations()
+        check = PreflightCheck(self._getConfig().validation.clearance_radius)
+        issues = check.check(smdparts, self._getBedBounds(), cancel.is_set, destinations)
+        if issues is None or cancel.is_set():
+            return
+        self._preflightIssues = issues
+        self._logger.info("Pre-flight check of %d parts found %d problems in %.2f s", smdparts.getPartCount(), len(issues), time.time() - start)
+        for issue in issues[:self.PREFLIGHT_LOG_LIMIT]:
+            self._logger.info("Pre-flight check: " + issue.message)
+        if issues:
+            self._updateUI("ERROR", "Pre-flight check found " + str(len(issues)) + " problems: " + issues[0].message +
+                           (" and more" if len(issues) > 1 else ""))
+
+    # (min x, min y, max x, max y, max z) of the print volume from the printer profile
+    def _getBedBounds(self):
+        volume = self._printer_profile_manager.get_current_or_default()["volume"]
+        box = volume.get("custom_box")
+        if box:
+            return (box["x_min"], box["y_min"], box["x_max"], box["y_max"], box["z_max"])
+        width, depth, height = float(volume["width"]), float(volume["depth"]), float(volume["height"])
+        if volume.get("origin") == "center":
+            return (-width / 2, -depth / 2, width / 2, depth / 2, height)
+        return (0.0, 0.0, width, depth, height)
+
+    # fill smdparts with the part information of the file at path, either from the metadata stored at upload,
+    # the part cache or by scanning the file. Returns (sane, error message), (False, "") if the file contains no part information
+    def _loadParts(self, smdparts, path, progress=None, cancelled=None, metadata=None):
+        if metadata is not None and metadata.get("size") == os.path.getsize(path):
+            if metadata.get("error"):
+                return False, metadata["error"]
+            if not metadata.get("digest"):
+                return False, ""
+            cached = self._partCache.lookupDigest(metadata["digest"])
+            if cached:
+                self._logger.info("Loaded part information for %s from upload metadata", path)
+                return smdparts.load(cached, sanitize=False)
+
+        cached = self._partCache.lookup(path)
+        if cached is not None:
+            if not cached:
+                return False, ""
+            self._logger.info("Loaded part information for %s from cache", path)
+            return smdparts.load(cached, sanitize=False)
+
+        extractor = XmlExtractor()
+        root, msg = extractor.readFile(path, progress=progress, cancelled=cancelled)
+        if cancelled is not None and cancelled():
+            return False, ""
+        if root is None:
+            if not msg:
+                self._partCache.store(path, None, b"")
+            return False, msg
+
+        # same part description might be cached for a different file
+        digest = extractor.getDigest()
+        cached = self._partCache.lookupDigest(digest)
+        if cached:
+            sane, msg = smdparts.load(cached, sanitize=False)
+        else:
+            #parse xml data
+            sane, msg = smdparts.load(root)
+        if sane:
+            self._partCache.store(path, digest, cached or smdparts.dump())
+        return sane, msg
+
+    # scan all files in the upload folder which are not cached yet
+    def _prewarmPartCache(self):
+        uploads = self._settings.global_get_basefolder("uploads")
+        for folder, _, files in os.walk(uploads):
+            for name in files:
+                if os.path.splitext(name)[1].lower() not in self.GCODE_EXTENSIONS:
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    if self._partCache.lookup(path) is None:
+                        self._loadParts(SmdParts(), path)
+                except Exception:
+                    self._logger.exception("Could not cache part information for %s", path)
+        self._logger.info("Part cache prewarmed, %d bytes cached", self._partCache.getSize())
+
+    # Wrap uploads of gcode files to extract their part information while the file is written.
+    # The result is stored in the file metadata and the part cache once the file has been added.
+    def hook_file_preprocessor(self, path, file_object, links=None, printer_profile=None, allow_overwrite=False, *args, **kwargs):
+        if os.path.splitext(path)[1].lower() not in self.GCODE_EXTENSIONS:
+            return file_object
+        from octoprint.filemanager.util import StreamWrapper
+        from .UploadScanner import UploadScanner
+        scanner = UploadScanner(file_object.stream(), lambda root, msg, digest: self._scannedUpload(path, root, msg, digest))
+        return StreamWrapper(file_object.filename, scanner)
+
+    # called by the UploadScanner at the end of an upload
+    def _scannedUpload(self, path, root, msg, digest):
+        try:
+            upload = dict(parts=0, error=msg, digest=None, data=b"", fits=True, verdict=None)
+            if root is not None:
+                smdparts = SmdParts()
+                sane, upload["error"] = smdparts.load(root)
+                if sane:
+                    upload.update(parts=smdparts.getPartCount(), digest=digest, data=smdparts.dump())
+                    if self._getConfig() is None:
+                        upload["verdict"] = "Invalid settings: " + self._configError
+                    else:
+                        upload["verdict"] = self._assignBoxes(smdparts)[1]
+                    upload["fits"] = upload["verdict"] is None
+            with self._uploadsLock:
+                self._uploads[path] = upload
+        except Exception:
+            self._logger.exception("Scanning upload %s for part information failed", path)
+
+    # store the scanned part information of an added file in its metadata and the part cache
+    def _storeUploadParts(self, path):
+        with self._uploadsLock:
+            upload = self._uploads.pop(path, None)
+        if upload is None:
+            return
+        fullpath = self._file_manager.path_on_disk("local", path)
+        self._partCache.store(fullpath, upload["digest"], upload["data"])
+        metadata = dict((key, upload[key]) for key in ("parts", "error", "digest", "fits", "verdict"))
+        metadata["size"] = os.path.getsize(fullpath)
+        self._file_manager.set_additional_metadata("local", path, self.METADATA_KEY, metadata, overwrite=True)
+        self._logger.info("Stored part information of upload %s: %d parts", path, upload["parts"])
+
+    def _getUploadMetadata(self, origin, path):
+        if origin != "local" or not path:
+            return None
+        return self._file_manager.get_additional_metadata("local", path, self.METADATA_KEY)
+
+    # block until part information of the currently selected file is available, returns False on timeout
+    def _waitForParts(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            loaded = self._partsLoaded
+            if not loaded.wait(max(0, deadline - time.monotonic())):
+                return False
+            # a newer file might have been selected in the meantime
+            if loaded is self._partsLoaded:
+                return True
 
 
     """
     Use the gcode hook to interrupt the printing job on custom M361 commands.
+    Several parts can be placed in one go with "M361 P1,P2,P3": the print is paused once, the magnet
+    extruder is selected once and the parts are picked in an order which minimises travel.
+    During a print job, the primary extruder is not selected again before the next non-M361 line,
+    so consecutive M361 lines also share one tool change.
+    M361 commands which arrive while parts are placed are queued and placed directly after the
+    current batch, without resuming the print in between.
     """
     def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-        if "M361" in cmd:
-            if self._state == self.STATE_NONE:
-                self._state = self.STATE_PICK
-                command = re.search("P\d*", cmd).group() #strip the M361
-                self._currentPart = int(command[1:])
-
-                self._logger.info( "Received M361 command to place part: " + str(self._currentPart))
-
-                # pause running printjob to prevent octoprint from sending new commands from the gcode file during the interactive PnP process
-                if self._printer.is_printing() or self._printer.is_resuming():
-                    self._printer.pause_print()
-
-                self._updateUI("OPERATION", "pick")
-
-                self._printer.commands("M400")
-                self._printer.commands("G4 P1")
-                self._printer.commands("M400")
-                for i in range(10):
-                    self._printer.commands("G4 P1")
-
-                self._printer.commands("M362 OctoMagnetPNP")
-
-
+        # called for every single line, OctoPrint already parsed the command code
+        if gcode != "M361":
+            if self._magnetSelected and not cmd.startswith(self.SYNC_COMMAND):
+                with self._stateLock:
+                    if self._magnetSelected and self._state == self.STATE_NONE:
+                        # first line after a series of M361 commands
+                        self._magnetSelected = False
+                        return ["T0", cmd]
+            return
+        if not self._waitForParts(self.EXTRACTION_TIMEOUT):
+            self._logger.info("ERROR, part information not available, ignoring M361 command")
+            self._updateUI("ERROR", "Part information still loading, M361 ignored")
+            return
+        if self._getConfig() is None:
+            self._logger.info("ERROR, invalid settings, ignoring M361 command: " + self._configError)
+            self._updateUI("ERROR", "Invalid settings, M361 ignored: " + self._configError)
+            return (None,)
+        with self._stateLock:
+            # the plan is only replaced under the state lock, the parts are checked against the plan they are placed with
+            parts = self._parseParts(cmd)
+            if not parts:
+                return (None,)
+            if self._state != self.STATE_NONE:
+                self._pending.append(parts)
+                self._logger.info("Received M361 command while placing part " + str(self._currentPart) + ", queued parts: " +
+                                  ", ".join(str(p) for p in parts) + " (" + str(len(self._pending)) + " pending)")
+                self._updateUI("QUEUE", len(self._pending))
                 return (None,) # suppress command
+
+            # look everything up before the state changes, the state machine only runs with a complete batch
+            batch = self._orderBatch(parts)
+            nut = self._plan.getPart(batch[0]).nut
+            self._batch = batch
+            self._currentPart = self._batch.pop(0)
+            self._state = self.STATE_PICK
+
+            # OctoPrint tracks the head height of all moves, it only is the print height if the print moved the head since the last placement
+            currentZ = self._printer.get_current_data().get("currentZ")
+            if currentZ is None or self._headZ is None or abs(currentZ - self._headZ) > 0.001:
+                self._printZ = currentZ
+            self._logger.info( "Received M361 command to place parts: " + ", ".join(str(p) for p in parts))
+            # until the print job is paused and the printer finished all queued moves
+            self._metrics.start("pause", nut, self._currentPart)
+
+            # pause running printjob to prevent octoprint from sending new commands from the gcode file during the interactive PnP process
+            self._pausedPrint = False
+            if self._printer.is_printing() or self._printer.is_resuming():
+                self._printer.pause_print()
+                self._pausedPrint = True
+
+            self._updateUI("OPERATION", "pick")
+
+            self._printer.commands(self._syncCommands())
+
+            return (None,) # suppress command
+
+    # part numbers of a M361 command, parts without tray box are reported and skipped
+    def _parseParts(self, cmd):
+        parts = []
+        plan = self._plan
+        for parameter in self.PART_PARAMETER.findall(cmd):
+            partnr = int(parameter)
+            if partnr in self._skipParts:
+                self._logger.info("Part " + str(partnr) + " already placed before the job was interrupted, skipping")
+            elif plan is not None and partnr in plan:
+                parts.append(partnr)
             else:
-                self._logger.info( "ERROR, received M361 command while placing part: " + str(self._currentPart))
+                self._logger.info("ERROR, no tray box for part " + str(partnr))
+                self._updateUI("ERROR", "No tray box for part " + str(partnr))
+        if not self.PART_PARAMETER.search(cmd):
+            self._logger.info("ERROR, M361 command without part number: " + cmd)
+            self._updateUI("ERROR", "M361 command without part number")
+        return parts
+
+    # Order parts to minimise travel from each destination to the tray box of the next part (nearest neighbour).
+    # The first part is kept, since the position of the head before the batch is unknown.
+    def _orderBatch(self, parts):
+        ordered = parts[:1]
+        remaining = parts[1:]
+        while remaining:
+            x, y = self._plan.getPart(ordered[-1]).destination[:2]
+            def travel(partnr):
+                box = self._plan.getPart(partnr).tray_position
+                return (box[0] - x) ** 2 + (box[1] - y) ** 2
+            nearest = min(remaining, key=travel)
+            remaining.remove(nearest)
+            ordered.append(nearest)
+        return ordered
 
     """
     This hook is designed as some kind of a "state machine". The reason is,
@@ -188,217 +724,498 @@ class OctoMagnetPNP(octoprint.plugin.StartupPlugin,
     camera positioning command, followed by a M362. This causes the printer to send the
     next acknowledging ok not until the positioning is finished. Since the next command is a M362,
     octoprint will call the gcode hook again and we are back in the game, iterating to the next state.
-    Since both, Octoprint and the printer firmware are using a queue, we inject some "G4 P1" commands
-    as a "clearance buffer". Those commands simply cause the printer to wait for a millisecond.
+    Some firmwares acknowledge M400 before the moves are finished. For those, the "clearance buffer"
+    setting injects additional "G4 P1" commands, which simply cause the printer to wait for a millisecond.
     """
-    # _pickPart --> _alignPart --> _placePart
+    # _pickPart --> _alignPart --> _placePart (--> _pickPart for the next part of a batch)
+    # With the overlap rotation setting, the part is rotated while moving to its destination: _pickPart --> _placePart
     def hook_gcode_sending(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-        if "M362 OctoMagnetPNP" in cmd:
+        # called for every single line, OctoPrint already parsed the command code
+        if gcode != "M362":
+            return
+        if cmd == self.DONE_COMMAND:
+            self._metrics.finish("place")
+            self._metrics.finish("part")
+            self._partPlaced()
+            return (None,) # suppress command
+        if not cmd.startswith(self.SYNC_COMMAND):
+            return
+        with self._stateLock:
             if self._state == self.STATE_PICK:
-                self._state = self.STATE_ALIGN
+                self._partPlan = self._getPartPlan(self._currentPart)
+                # parts rotated during the travel to the destination have no align step
+                self._state = self.STATE_ALIGN if self._partPlan.align else self.STATE_PLACE
                 self._logger.info("Pick part " + str(self._currentPart))
-
-                self._pickPart(self._currentPart)
-                self._printer.commands("M400")
-                self._printer.commands("G4 P1")
-                self._printer.commands("M400")
-
-                for i in range(10):
-                    self._printer.commands("G4 P1")
-
-                self._printer.commands("M362 OctoMagnetPNP")
+                nut = self._partPlan.nut
+                self._metrics.finish("pause")
+                self._metrics.finish("place")
+                self._metrics.finish("part")
+                self._metrics.start("part", nut, self._currentPart)
+                self._metrics.start("pick", nut, self._currentPart)
+                self._partPlaced()
+
+                commands = []
+                if not self._magnetSelected:
+                    commands.append(self._plan.getMagnetTool())
+                    self._magnetSelected = True
+                commands.extend(self._pickPart(self._currentPart))
+                self._printer.commands(commands + self._syncCommands())
 
                 return (None,) # suppress command
 
             if self._state == self.STATE_ALIGN:
                 self._state = self.STATE_PLACE
                 self._logger.info("Align part " + str(self._currentPart))
+                self._metrics.finish("pick")
+                self._metrics.start("align", self._partPlan.nut, self._currentPart)
+                self._journal.record("pick", self._currentPart)
 
-                self._alignPart(self._currentPart)
-                self._printer.commands("M400")
-                self._printer.commands("G4 P1")
-                self._printer.commands("M400")
-
-                for i in range(10):
-                    self._printer.commands("G4 P1")
-
-                self._printer.commands("M362 OctoMagnetPNP")
+                self._printer.commands(self._alignPart(self._currentPart) + self._syncCommands())
 
                 return (None,) # suppress command
 
             if self._state == self.STATE_PLACE:
                 self._logger.info("Place part " + str(self._currentPart))
-
-                self._placePart(self._currentPart)
-                self._printer.commands("M400")
-                self._printer.commands("G4 P1")
-                self._printer.commands("M400")
-
-                for i in range(10):
-                    self._printer.commands("G4 P1")
-
+                self._metrics.finish("pick")
+                self._metrics.finish("align")
+                self._metrics.start("place", self._partPlan.nut, self._currentPart)
+                self._journal.record("align" if self._partPlan.align else "pick", self._currentPart)
+                self._placing = (self._currentPart, self._partPlan.box)
+                # the next part has to clear this one
+                top = self._partPlan.destination[2]
+                self._placedTop = top if self._placedTop is None else max(self._placedTop, top)
+
+                commands = self._placePart(self._currentPart)
                 self._logger.info("Finished placing part " + str(self._currentPart))
+                self._updateUI("OPERATION", "place")
+
+                # continue with the next part of the batch or with the parts of the next queued M361 command
+                if not self._batch and self._pending:
+                    self._batch = self._orderBatch(self._pending.popleft())
+                    self._logger.info("Placing queued parts: " + ", ".join(str(p) for p in self._batch))
+                    self._updateUI("QUEUE", len(self._pending))
+                if self._batch:
+                    self._printer.commands(commands + self._syncCommands())
+                    self._currentPart = self._batch.pop(0)
+                    self._state = self.STATE_PICK
+                    self._updateUI("OPERATION", "pick")
+                    return (None,) # suppress command
+
+                # switch back to primary extruder, deferred to the next gcode line of a print job
+                if not self._pausedPrint:
+                    commands.append("T0")
+                    self._magnetSelected = False
+                self._printer.commands(commands + self._syncCommands(self.DONE_COMMAND))
+                self._headZ = self._partPlan.travel_height
                 self._state = self.STATE_NONE
+                if self._jobOutdated:
+                    self._startPrepareJob()
 
                 # resume paused printjob into normal operation
                 if self._printer.is_paused() or self._printer.is_pausing():
                     self._printer.resume_print()
+                    self._metrics.event("resume", self._currentPart)
 
                 return (None,) # suppress command
 
 
+    # the printer finished the place step of the previous part: its nut is taken from the inventory and it is journaled
+    def _partPlaced(self):
+        with self._stateLock:
+            if self._placing is None:
+                return
+            partnr, box = self._placing
+            self._placing = None
+            self._inventory.consume(box)
+            self._placedBoxes[partnr] = box
+            self._journal.placed(partnr)
+
+    # Commands to wait for the printer to finish all queued moves. OctoPrint sends the next command only after the
+    # M400 has been acknowledged, so the sending hook advances the state machine when SYNC_COMMAND is due.
+    # Every step submits its commands and the synchronization in a single call to _printer.commands().
+    # The last step of a batch ends with DONE_COMMAND, which only finishes the timing of the placement.
+    def _syncCommands(self, marker=SYNC_COMMAND):
+        if self._getConfig().sync.clearance_buffer:
+            commands = ["M400", "G4 P1", "M400"] + ["G4 P1"] * 10
+        else:
+            commands = ["M400"]
+        commands.append(marker)
+        return commands
+
+    # Compiled placement of a part. The plan expects the parts in file order, the travel height of a part
+    # clears the parts placed at or below its own destination. If the print or a part placed in this job
+    # is higher, the part is compiled again with a travel height which clears them.
+    def _getPartPlan(self, partnr):
+        part = self._plan.getPart(partnr)
+        top = self._getClearanceTop()
+        if top is not None and self._getMotionProfile().getTravelHeight(partnr, top) > part.travel_height:
+            part = self._compilePart(partnr, part.box, [None, None, None], top)
+            self._logger.info("Travel height of part %d raised to %s to clear height %s", partnr, part.travel_height, top)
+        return part
+
+    # height which the head and the carried part have to clear: the print and all parts placed in this job, None if unknown
+    def _getClearanceTop(self):
+        heights = [z for z in (self._printZ, self._placedTop) if z is not None]
+        return max(heights) if heights else None
+
+    # the following return the commands of a step of the part being placed as a new list
     def _pickPart(self, partnr):
+        return list(self._partPlan.pick)
+
+    # append the pick moves of a part from tray box nr box to sequence, returns the position of the magnet at the tray box
+    # height is the travel height of the magnet
+    def _pickSequence(self, sequence, partnr, box, height):
         part_offset = [0, 0]
 
         self._logger.info("PART OFFSET:" + str(part_offset))
 
-        tray_offset = self._getTrayPosFromPartNr(partnr)
-        vacuum_dest = [tray_offset[0]+part_offset[0]-float(self._settings.get(["magnet", "x"])),\
-                         tray_offset[1]+part_offset[1]-float(self._settings.get(["magnet", "y"])),\
+        magnet = self._getConfig().magnet
+        parameters = self._getMotionParameters(partnr, box)
+        tray_offset = self._getTrayPosFromBox(partnr, box)
+        vacuum_dest = [tray_offset[0]+part_offset[0]-magnet.x,\
+                         tray_offset[1]+part_offset[1]-magnet.y,\
                          tray_offset[2]]
 
         # move magnet to part and pick
-        self._printer.commands("T" + str(self._settings.get(["magnet", "extruder_nr"])))
-        cmd = "G1 X" + str(vacuum_dest[0]) + " Y" + str(vacuum_dest[1]) + " F" + str(self.FEEDRATE)
-        self._printer.commands(cmd)
-        self._printer.commands("G1 Z" + str(vacuum_dest[2]+10))
-        self._releaseMagnet()
-        self._printer.commands("G1 Z" + str(vacuum_dest[2]) + "F1000")
-        self._gripMagnet()
-        self._printer.commands("G4 P500")
-        self._printer.commands("G1 Z" + str(vacuum_dest[2]+5) + "F1000")
+        sequence.travel(vacuum_dest[0], vacuum_dest[1], height, parameters["feedrate_xy"], parameters["feedrate_z"])
+        self._releaseMagnet(sequence, parameters, parameters["settle_dwell"])
+        sequence.moveZ(vacuum_dest[2], parameters["feedrate_z"])
+        self._gripMagnet(sequence, parameters, parameters["grip_dwell"])
+        sequence.moveZ(height, parameters["feedrate_z"])
+        return vacuum_dest
 
     def _alignPart(self, partnr):
-        orientation_offset = 0
+        return list(self._partPlan.align)
 
-        # find destination at the object
-        rotation = self.smdparts.getPartRotation(partnr)
-        if self.smdparts.getPartOrientation(partnr).lower() == "flat":
-            rotation += float(self._settings.get(["tray", "part_rotation_flat"]))
-        elif self.smdparts.getPartOrientation(partnr).lower() == "upright":
-            rotation += float(self._settings.get(["tray", "part_rotation_upright"]))
+    def _alignSequence(self, sequence, partnr, box):
+        rotation = self._getPartRotation(partnr)
 
         #rotate object
-        self._printer.commands("G92 E0")
-        self._printer.commands("G1 E" + str(rotation) + " F1000")
+        sequence.rotate(rotation, self._getMotionParameters(partnr, box)["feedrate_rotation"])
         self._logger.info("object rotation: " + str(rotation))
 
+    # rotation of the magnet extruder for a part, relative to its orientation in the tray
+    def _getPartRotation(self, partnr):
+        tray = self._getConfig().tray
+        rotation = self.smdparts.getPartRotation(partnr) + self._getDestinations()[partnr][3]
+        if self.smdparts.getPartOrientation(partnr).lower() == "flat":
+            rotation += tray.part_rotation_flat
+        elif self.smdparts.getPartOrientation(partnr).lower() == "upright":
+            rotation += tray.part_rotation_upright
+        return rotation
+
     def _placePart(self, partnr):
-        displacement = [0, 0]
+        return list(self._partPlan.place)
 
-        # find destination at the object
-        destination = self.smdparts.getPartDestination(partnr)
+    # append the place moves to sequence, returns the position of the magnet at the destination
+    # height is the travel height, with rotation, the part is rotated during the travel to the destination
+    def _placeSequence(self, sequence, partnr, box, height, rotation=None):
+        magnet = self._getConfig().magnet
+        parameters = self._getMotionParameters(partnr, box)
 
-        self._logger.info("displacement - x: " + str(displacement[0]) + " y: " + str(displacement[1]))
+        # find destination at the object, corrected by the bed calibration
+        destination = self._getDestinations()[partnr]
 
         # move to destination
         dest_z = destination[2]+self.smdparts.getPartHeight(partnr)
-        cmd = "G1 X" + str(destination[0]-float(self._settings.get(["magnet", "x"]))+displacement[0]) \
-              + " Y" + str(destination[1]-float(self._settings.get(["magnet", "y"]))+displacement[1]) \
-              + " F" + str(self.FEEDRATE)
-        self._logger.info("object destination: " + cmd)
-        self._printer.commands("G1 Z" + str(dest_z+10) + " F" + str(self.FEEDRATE))  # lift printhead
-        self._printer.commands(cmd)
-        self._printer.commands("G1 Z" + str(dest_z))
-
-        #release part
-        self._releaseMagnet()
-        self._printer.commands("G4 P500") #some extra time to make sure the part has released and the remaining vacuum is gone
-        self._printer.commands("G1 Z" + str(dest_z+10) + " F" + str(self.FEEDRATE)) # lift printhead again
-        self._printer.commands("T0") # switch back to primary extruder
+        dest_x = destination[0]-magnet.x
+        dest_y = destination[1]-magnet.y
+        self._logger.info("object destination: X%s Y%s Z%s", dest_x, dest_y, dest_z)
+        sequence.travel(dest_x, dest_y, height, parameters["feedrate_xy"], parameters["feedrate_z"],
+                        rotation, parameters["feedrate_rotation"])
+        if rotation is not None:
+            self._logger.info("object rotation: " + str(rotation))
+        sequence.moveZ(dest_z, parameters["feedrate_z"])
+
+        #release part, dwell gives some extra time to make sure the part has released
+        self._releaseMagnet(sequence, parameters, parameters["release_dwell"])
+        sequence.moveZ(height, parameters["feedrate_z"]) # lift printhead again
+        return [dest_x, dest_y, dest_z]
+
+    # Assign tray boxes and compile the placement plan for the loaded file, then send it to the UI.
+    # Tray boxes, plan and part table are built aside and published together. A running placement keeps
+    # its plan, the job is prepared again when it is finished. Returns the error sent to the UI if the
+    # parts do not fit into the tray, None otherwise.
+    def _prepareJob(self):
+        with self._jobLock:
+            with self._stateLock:
+                if self._state != self.STATE_NONE:
+                    self._jobOutdated = True
+                    return None
+                self._jobOutdated = False
+            positions = {}
+            error = None
+            plan = None
+            try:
+                if self.smdparts.isFileLoaded() and self._getConfig() is None:
+                    error = "Invalid settings, no placement plan: " + self._configError
+                elif self.smdparts.isFileLoaded():
+                    positions, error = self._assignTrayBoxes()
+                    if error is None:
+                        plan = self._compilePlan(positions)
+            except Exception:
+                # never keep the plan of the previous file
+                self._logger.exception("Compiling the placement plan failed")
+                positions, plan = {}, None
+                error = "Could not compile the placement plan"
+            table = self._buildPartTable(plan)
+            with self._stateLock:
+                # a placement started in the meantime
+                if self._state != self.STATE_NONE:
+                    self._jobOutdated = True
+                    return None
+                self.partPositions = positions
+                self._plan = plan
+                self._partTable = table
+        if error is not None:
+            self._logger.info(error)
+            self._updateUI("ERROR", error)
+            return error
+        if plan is not None:
+            self._logger.info("Estimated placement time: %.1f s", plan.getCycleTime())
+        self._updateUI("FILE", "")
+        return None
+
+    # prepare the job in a background thread, used when the sending thread finished a placement
+    def _startPrepareJob(self):
+        worker = threading.Thread(target=self._prepareJob, name="OctoMagnetPNP job preparation")
+        worker.daemon = True
+        worker.start()
+
+    # Immutable snapshot of the part table for the UI: (ETag, JSON body). The UI fetches it once per version
+    # (the ETag, also sent with the FILE message), afterwards it is only updated by OPERATION messages.
+    def _buildPartTable(self, plan):
+        partArray = []
+        if plan is not None:
+            tolerance = self._getConfig().ui.shape_tolerance
+            for partId in plan.getPartIds():
+                part = plan.getPart(partId)
+                partArray.append(
+                    dict(
+                        id = partId,
+                        name = self.smdparts.getPartName(partId),
+                        partPosition = part.tray_box,
+                        tray = part.tray,
+                        shape = self.smdparts.getPartOutline(partId, tolerance),
+                        type = self.smdparts.getPartType(partId),
+                        threadSize = self.smdparts.getPartThreadSize(partId),
+                        partOrientation = self.smdparts.getPartOrientation(partId).lower(),
+                        cycleTime = part.cycle_time
+                    )
+                )
+        config = self._getConfig()
+        body = json.dumps(dict(parts=partArray, calibration=config.calibration.version if config is not None else None)).encode("utf-8")
+        return '"' + hashlib.sha1(body).hexdigest() + '"', body
+
+    # tray box of a part and the nuts left in it, sent with OPERATION and ERROR messages
+    def _getBoxUpdate(self, partnr):
+        plan = self._plan
+        if plan is None or partnr not in plan:
+            return {}
+        part = plan.getPart(partnr)
+        return dict(tray=part.tray, box=part.tray_box, remaining=self._inventory.getRemaining(part.box))
+
+    # offer to skip the placed parts if the journal holds an interrupted job of the selected file
+    def _offerResume(self):
+        unfinished = self._journal.getUnfinished()
+        if unfinished is None or unfinished["file"] != self._filePath or self._skipParts:
+            return
+        self._logger.info("Interrupted job of %s placed %d parts", unfinished["file"], len(unfinished["placed"]))
+        self._updateUI("RESUME", unfinished)
+
+    # skip the parts which the interrupted job of the selected file already placed
+    def _resumeJob(self):
+        unfinished = self._journal.getUnfinished()
+        if unfinished is None or unfinished["file"] != self._filePath:
+            self._updateUI("ERROR", "No interrupted job of the selected file")
+            return
+        self._skipParts = frozenset(unfinished["placed"])
+        self._journal.resume()
+        self._logger.info("Resuming job of %s, skipping parts: %s", self._filePath, ", ".join(str(p) for p in unfinished["placed"]))
+        if self.smdparts.isFileLoaded():
+            self._prepareJob()
+
+    # Reassign the tray boxes from the current inventory, since previous jobs might have used the nuts assigned
+    # when the file was loaded. Cancels the job if the tray does not hold enough nuts for all parts.
+    def _checkInventory(self):
+        if not self._waitForParts(self.EXTRACTION_TIMEOUT):
+            return
+        with self._stateLock:
+            self._placedBoxes = {}
+            self._placedTop = None
+        error = self._prepareJob()
+        if error is not None:
+            self._logger.info("ERROR, cannot place the parts of this job, cancelling print job: " + error)
+            self._printer.cancel_print()
+
+    # tray box for every part of the loaded file from the nuts left in the tray, returns (assignment, error message).
+    # Parts placed since the job started keep their box, their nuts are already consumed.
+    def _assignTrayBoxes(self):
+        with self._stateLock:
+            placed = dict(self._placedBoxes)
+        return self._assignBoxes(self.smdparts, self._skipParts, self._getConfig().tray.minimize_travel, self._getDestinations(), placed)
+
+    # tray box for every part of smdparts except skip from the nuts left in the tray, returns (assignment, None)
+    # or ({}, error message) if a part does not fit. destinations are the calibrated destinations, if known.
+    # keep maps parts to boxes they keep without drawing from the stock, as long as the box still holds their nut.
+    def _assignBoxes(self, smdparts, skip=(), minimize_travel=False, destinations=None, keep=None):
+        layout = self._getTrayLayout()
+        boxes = layout.getBoxes()
+        self._inventory.configure(boxes)
+        requests = []
+        kept = {}
+        for partnr in smdparts.getPartIds():
+            if partnr in skip:
+                continue
+            request = SlotRequest(partnr, smdparts.getPartThreadSize(partnr), smdparts.getPartType(partnr),
+                                  smdparts.getPartOrientation(partnr),
+                                  destinations[partnr] if destinations is not None else smdparts.getPartDestination(partnr))
+            box = keep.get(partnr) if keep else None
+            if (box is not None and box < len(boxes) and SlotAssignment.getKey(request.thread_size, request.nut, request.orientation) ==
+                    SlotAssignment.getKey(boxes[box].get("thread_size"), boxes[box].get("nut"), boxes[box].get("slot_orientation"))):
+                kept[partnr] = box
+            else:
+                requests.append(request)
+        assignment = SlotAssignment(boxes, layout.getPositions(), self._inventory.getStock(), layout.getTrays())
+        positions, unassigned = assignment.assign(requests, minimize_travel)
+        if unassigned:
+            request = unassigned[0]
+            return {}, ("No tray box for part no " + str(request.partnr) + " (" + str(request.nut) + " M" + str(request.thread_size) +
+                        ", part orientation: " + str(request.orientation).lower() + ") left")
+        positions.update(kept)
+        return positions, None
+
+    # Compile the gcode for all parts with a tray box. The pick step always starts at an unknown height
+    # (after printing or after the previous part), the XY position of the previous part in file order
+    # is only used to estimate the cycle time. With the overlap rotation setting, the align step is empty
+    # and the part is rotated during the travel to its destination.
+    # positions is the tray box of every part which gets placed
+    def _compilePlan(self, positions):
+        self._motionProfile = None
+        parts = []
+        position = [None, None, None]
+        for partnr in self.smdparts.getPartIds():
+            if partnr not in positions:
+                continue
+            part = self._compilePart(partnr, positions[partnr], [position[0], position[1], None])
+            parts.append(part)
+            position = list(part.destination)
+        return PlacementPlan(parts, formatCommand("T", self._getConfig().magnet.extruder_nr))
+
+    # Compile the steps of a part from tray box nr box, starting at position [x, y, z] (coordinates may be None).
+    # With top, the travel height also clears everything up to this height.
+    def _compilePart(self, partnr, box, position, top=None):
+        layout = self._getTrayLayout()
+        height = self._getMotionProfile().getTravelHeight(partnr, top)
+        sequence = MoveSequence(position)
+        tray = self._pickSequence(sequence, partnr, box, height)
+        pick = len(sequence.commands)
+        if self._getConfig().motion.overlap_rotation:
+            align = pick
+            destination = self._placeSequence(sequence, partnr, box, height, self._getPartRotation(partnr))
+        else:
+            self._alignSequence(sequence, partnr, box)
+            align = len(sequence.commands)
+            destination = self._placeSequence(sequence, partnr, box, height)
+        return PartPlan(partnr, self.smdparts.getPartType(partnr), box, layout.getTray(box), layout.getTrayBox(box), tuple(tray),
+                        tuple(destination), height,
+                        tuple(sequence.commands[:pick]), tuple(sequence.commands[pick:align]), tuple(sequence.commands[align:]),
+                        sequence.duration)
+
+    # Destinations of all parts on the bed as (x, y, z, rotation correction in degrees), transformed in one batch
+    # when a file is loaded or the calibration version changes, so compiling the plan does no calibration math
+    def _getDestinations(self):
+        calibration = self._getConfig().calibration
+        cached = self._destinations
+        if cached is None or cached[0] is not self.smdparts or cached[1] != calibration.version:
+            ids = self.smdparts.getPartIds()
+            destinations = [self.smdparts.getPartDestination(partnr) for partnr in ids]
+            points = [(destination[0], destination[1]) for destination in destinations]
+            transform = calibration.transform
+            if transform.isIdentity():
+                rotations = [0.0] * len(points)
+            else:
+                rotations = transform.getRotations(points)
+                points = transform.applyAll(points)
+            table = dict((partnr, (point[0], point[1], destination[2], rotation))
+                         for partnr, point, destination, rotation in zip(ids, points, destinations, rotations))
+            cached = self._destinations = (self.smdparts, calibration.version, table)
+        return cached[2]
+
+    # motion profile for the loaded file, rebuilt after settings changes
+    def _getMotionProfile(self):
+        if self._motionProfile is None:
+            motion = self._getConfig().motion
+            layout = self._getTrayLayout()
+            self._motionProfile = MotionProfile(motion._asdict(), motion.nut_profiles, layout.getBoxes(), motion.clearance)
+            if self.smdparts.isFileLoaded():
+                self._motionProfile.computeTravelHeights(self.smdparts, layout.getMaxZ())
+        return self._motionProfile
+
+    def _getMotionParameters(self, partnr, box):
+        return self._getMotionProfile().getParameters(box, self.smdparts.getPartType(partnr))
 
     # get the position of the box (center of the box) containing part x relative to the [0,0] corner of the tray
-    def _getTrayPosFromPartNr(self, partnr):
-        partPos = self.partPositions[partnr]
-        row = partPos / int(self._settings.get(["tray", "columns"]))
-        col = ((partPos) % int(self._settings.get(["tray", "columns"])))
-        self._logger.info("Selected object: %d. Position: box %d, row %d, col %d", partnr, partPos, row, col)
-
-        boxsize = float(self._settings.get(["tray", "boxsize"]))
-        x = col * boxsize + float(self._settings.get(["tray", "x"]))
-        y = row * boxsize + float(self._settings.get(["tray", "y"]))
-        return [x, y, float(self._settings.get(["tray", "z"]))]
-
-    def _gripMagnet(self):
-        self._printer.commands("M400")
-        self._printer.commands("M400")
-        self._printer.commands("G4 P500")
-        for line in self._settings.get(["magnet", "grip_magnet_gcode"]).splitlines():
-            self._printer.commands(line)
-        self._printer.commands("G4 P500")
-
-    def _releaseMagnet(self):
-        self._printer.commands("M400")
-        self._printer.commands("M400")
-        self._printer.commands("G4 P500")
-        for line in self._settings.get(["magnet", "release_magnet_gcode"]).splitlines():
-            self._printer.commands(line)
-        self._printer.commands("G4 P500")
+    def _getTrayPosFromBox(self, partnr, box):
+        layout = self._getTrayLayout()
+        self._logger.info("Selected object: %d. Position: tray %d, box %d", partnr, layout.getTray(box), layout.getTrayBox(box))
+        return layout.getPosition(box)
+
+    # box positions of all trays, rebuilt when the tray settings change
+    def _getTrayLayout(self):
+        tray = self._getConfig().tray
+        cached = self._trayLayout
+        if cached is None or cached[0] is not tray:
+            cached = self._trayLayout = (tray, TrayLayout(tray._asdict(), tray.additional_trays))
+        return cached[1]
+
+    def _gripMagnet(self, sequence, parameters, dwell):
+        sequence.append("M400")
+        sequence.dwell(parameters["settle_dwell"])
+        sequence.append(*self._getConfig().magnet.grip_magnet_gcode)
+        sequence.dwell(dwell)
+
+    def _releaseMagnet(self, sequence, parameters, dwell):
+        sequence.append("M400")
+        sequence.dwell(parameters["settle_dwell"])
+        sequence.append(*self._getConfig().magnet.release_magnet_gcode)
+        sequence.dwell(dwell)
 
     def _updateUI(self, event, parameter):
         data = dict(
             info="dummy"
         )
         if event == "FILE":
-            if self.smdparts.isFileLoaded():
-
-                # compile part information
-                partIds = self.smdparts.getPartIds()
-                self.partPositions = {}
-                partArray = []
-                usedTrayPositions = []
-                config = json.loads(self._settings.get(["tray", "boxconfiguration"]))
-                for partId in partIds:
-                    threadSize = self.smdparts.getPartThreadSize(partId)
-                    partType = self.smdparts.getPartType(partId)
-                    partOrientation = self.smdparts.getPartOrientation(partId).lower()
-                    trayPosition = None
-                    # find empty tray position, where the part fits
-                    for i, traybox in enumerate(config):
-                        if(float(traybox.get("thread_size")) == float(threadSize) and
-                           traybox.get("nut") == partType and
-                           traybox.get("slot_orientation") == partOrientation and
-                           i not in usedTrayPositions):
-                            usedTrayPositions.append(i)
-                            trayPosition = i
-                            self.partPositions[partId] = i
-                            break
-                    if(trayPosition is None):
-                        print("Error, no tray box for part no " + str(partId) + " (" + partType + " M" + str(threadSize) +
-                              ", part orientation: " + partOrientation + ") left")
-                        self._updateUI("ERROR", "No tray box for part no " + str(partId) + " (" + partType + " M" + str(threadSize) +
-                                       ", part orientation: " + partOrientation + ") left")
-                        return
-                    partArray.append(
-                        dict(
-                            id = partId,
-                            name = self.smdparts.getPartName(partId),
-                            partPosition = trayPosition,
-                            shape = self.smdparts.getPartShape(partId),
-                            type=partType,
-                            threadSize = threadSize,
-                            partOrientation = partOrientation
-                        )
-                    )
-
+            if self._plan is not None:
                 data = dict(
+                    version = self._partTable[0],
                     partCount = self.smdparts.getPartCount(),
-                    parts = partArray
+                    cycleTime = self._plan.getCycleTime(),
+                    inventory = self._inventory.getStock()
                 )
         elif event == "OPERATION":
             data = dict(
                 type = parameter,
                 part = self._currentPart
             )
+            data.update(self._getBoxUpdate(self._currentPart))
         elif event == "ERROR":
             data = dict(
                 type = parameter,
             )
-            if self._currentPart: data["part"] = self._currentPart
+            if self._currentPart:
+                data["part"] = self._currentPart
+                data.update(self._getBoxUpdate(self._currentPart))
         elif event == "INFO":
             data = dict(
                 type = parameter,
             )
+        elif event == "RESUME":
+            data = dict(parameter)
+        elif event == "QUEUE":
+            data = dict(
+                pending = parameter
+            )
 
         message = dict(
             event=event,
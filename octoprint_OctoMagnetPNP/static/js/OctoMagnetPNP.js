@@ -11,7 +11,10 @@ $(function() {
 
         self.stateString = ko.observable("No file loaded");
         self.currentOperation = ko.observable("");
+        self.pendingRequests = ko.observable(0);
+        self.resumeInfo = ko.observable("");
         self.debugvar = ko.observable("");
+        self.partTableVersion = undefined;
         //white placeholder images
 
         // This will get called before the ViewModel gets bound to the DOM, but after its depedencies have
@@ -22,6 +25,52 @@ $(function() {
             _smdTray = new smdTray(self.traySettings.columns(), self.traySettings.rows(), self.traySettings.boxsize(), _smdTrayCanvas, self.traySettings.boxconfiguration());
             _smdTrayCanvas.addEventListener("click", self.onSmdTrayClick, false); //"click, dblclick"
             _smdTrayCanvas.addEventListener("dblclick", self.onSmdTrayDblclick, false); //"click, dblclick"
+            self.loadPartTable();
+        }
+
+        // fetch the part table of the loaded file, unless this version is already drawn
+        self.loadPartTable = function(version) {
+            if(version !== undefined && version === self.partTableVersion) {
+                return;
+            }
+            var headers = {};
+            if(self.partTableVersion) {
+                headers["If-None-Match"] = self.partTableVersion;
+            }
+            OctoPrint.get(OctoPrint.getBlueprintUrl("OctoMagnetPNP") + "parts", {headers: headers})
+                .done(function(table, status, xhr) {
+                    if(status == "notmodified") {
+                        return;
+                    }
+                    self.partTableVersion = xhr.getResponseHeader("ETag");
+
+                    //initialize the tray
+                    _smdTray.erase();
+                    for(var i=0; i < table.parts.length; i++) {
+                        // only the first tray is drawn
+                        if(!table.parts[i].tray) {
+                            _smdTray.addPart(table.parts[i]);
+                        }
+                    }
+                });
+        }
+
+        // redraw the tray box of a part after an OPERATION or ERROR message
+        self.updateTrayBox = function(data, color) {
+            if(data.hasOwnProperty("box") && !data.tray) {
+                _smdTray.highlightPart(data.part, color);
+            }
+        }
+
+        // skip the parts placed by an interrupted job of the selected file, or start over
+        self.resumeJob = function() {
+            OctoPrint.simpleApiCommand("OctoMagnetPNP", "resume", {});
+            self.resumeInfo("");
+        }
+
+        self.discardJournal = function() {
+            OctoPrint.simpleApiCommand("OctoMagnetPNP", "discard_journal", {});
+            self.resumeInfo("");
         }
 
         // catch mouseclicks at the tray for interactive part handling
@@ -53,32 +102,40 @@ $(function() {
                 if (data.event == "FILE") {
                     if(data.data.hasOwnProperty("partCount")) {
                         self.stateString("Loaded file with " + data.data.partCount + " nuts");
-                        //initialize the tray
-                        _smdTray.erase();
-
-						//extract part information
-                        if( data.data.hasOwnProperty("parts") ) {
-							var parts = data.data.parts;
-							for(var i=0; i < parts.length; i++) {
-								_smdTray.addPart(parts[i]);
-							}
-						}
+                        if(data.data.hasOwnProperty("cycleTime")) {
+                            self.stateString(self.stateString() + ", estimated placement time " + Math.round(data.data.cycleTime) + " s");
+                        }
+                        self.loadPartTable(data.data.version);
                     }else{
                         self.stateString("No nuts part in this file!");
+                        self.partTableVersion = undefined;
+                        _smdTray.erase();
                     }
                 }
                 else if(data.event == "OPERATION") {
                     self.currentOperation(data.data.type + " part nr " + data.data.part);
+                    self.updateTrayBox(data.data, data.data.type == "place" ? "#6a6" : "red");
                 }
                 else if(data.event == "ERROR") {
                     self.stateString("ERROR: \"" + data.data.type + "\"");
                     if(data.data.hasOwnProperty("part")) {
-                        self.stateString(self.StateString + "appeared while processing part nr " + data.data.part);
+                        self.stateString(self.stateString() + " appeared while processing part nr " + data.data.part);
+                        self.updateTrayBox(data.data, "orange");
                     }
                 }
                 else if(data.event == "INFO") {
                     self.stateString("INFO: \"" + data.data.type + "\"");
                 }
+                else if(data.event == "RESUME") {
+                    var info = "An interrupted job of this file placed " + data.data.placed.length + " nuts.";
+                    if(data.data.current !== null) {
+                        info += " Part nr " + data.data.current + " was picked but not placed, check the magnet.";
+                    }
+                    self.resumeInfo(info);
+                }
+                else if(data.event == "QUEUE") {
+                    self.pendingRequests(data.data.pending);
+                }
                 //self.debugvar("Plugin = OctoMagnetPNP");
             }
         };
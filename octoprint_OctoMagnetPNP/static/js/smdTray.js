@@ -25,6 +25,13 @@ function smdTray(cols, rows, boxSize, canvas, config) {
         _drawPart(part.id, part.threadSize, part.type, "#aaa");
     }
 
+    // redraw a single part, e.g. while it is picked
+    self.highlightPart = function(partId, color) {
+        if(_parts[partId]) {
+            _drawPart(partId, _parts[partId].threadSize, _parts[partId].type, color);
+        }
+    }
+
     self.selectPart = function(x, y) {
         var canvasBoxSize = _getCanvasBoxSize();
         col = Math.floor(x/(canvasBoxSize+1)) + 1;
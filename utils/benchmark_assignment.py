@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Compares the tray box assignment of SlotAssignment with the former linear scan over
+all boxes for every part, and the total travel between boxes and destinations with
+and without travel optimisation. The stocked rows assign the parts to
+STOCKED_BOXES boxes per nut kind holding STOCK nuts each.
+
+Usage: python utils/benchmark_assignment.py [part count ...]
+"""
+
+from __future__ import print_function
+
+import math
+import random
+import sys
+import time
+
+import pnp_harness
+
+KINDS = [("3", "hexnut", "flat"), ("3", "hexnut", "upright"), ("4", "squarenut", "flat"), ("8", "hexnut", "flat")]
+COLUMNS = 20
+BOXSIZE = 10.0
+STOCK = 200
+STOCKED_BOXES = 5
+
+
+def generate(count, seed=1):
+    rng = random.Random(seed)
+    boxes = [dict(thread_size=kind[0], nut=kind[1], slot_orientation=kind[2]) for kind in
+             (KINDS[i % len(KINDS)] for i in range(count))]
+    rng.shuffle(boxes)
+    positions = [[(i % COLUMNS) * BOXSIZE, (i // COLUMNS) * BOXSIZE] for i in range(count)]
+    module = pnp_harness.load_plugin_module()
+    requests = []
+    for partnr in range(1, count + 1):
+        kind = KINDS[partnr % len(KINDS)]
+        destination = [rng.uniform(0, 200), rng.uniform(100, 300)]
+        requests.append(module.SlotRequest(partnr, kind[0], kind[1], kind[2], destination))
+    return boxes, positions, requests
+
+
+# assignment as previously done in _updateUI
+def legacy_assign(boxes, requests):
+    assignment = {}
+    used = []
+    for request in requests:
+        for i, box in enumerate(boxes):
+            if (float(box["thread_size"]) == float(request.thread_size) and box["nut"] == request.nut and
+                    box["slot_orientation"] == request.orientation and i not in used):
+                used.append(i)
+                assignment[request.partnr] = i
+                break
+    return assignment
+
+
+def travel(assignment, positions, requests):
+    return sum(math.hypot(positions[assignment[r.partnr]][0] - r.destination[0],
+                          positions[assignment[r.partnr]][1] - r.destination[1]) for r in requests)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main(counts):
+    module = pnp_harness.load_plugin_module()
+    print("%8s %12s %12s %12s %14s %14s" % ("parts", "linear scan", "indexed", "min. travel",
+                                             "travel (mm)", "min. (mm)"))
+    for count in counts:
+        boxes, positions, requests = generate(count)
+        legacy, legacy_time = timed(lambda: legacy_assign(boxes, requests))
+        (indexed, _), indexed_time = timed(lambda: module.SlotAssignment(boxes, positions).assign(requests))
+        (optimized, _), optimized_time = timed(lambda: module.SlotAssignment(boxes, positions).assign(requests, True))
+        assert indexed == legacy
+        print("%8d %11.4fs %11.4fs %11.4fs %14.0f %14.0f" % (count, legacy_time, indexed_time, optimized_time,
+                                                           travel(indexed, positions, requests),
+                                                           travel(optimized, positions, requests)))
+
+
+def main_stocked(counts):
+    module = pnp_harness.load_plugin_module()
+    print("%8s %8s %12s %14s" % ("parts", "boxes", "min. travel", "min. (mm)"))
+    for count in counts:
+        _, _, requests = generate(count)
+        boxes = [dict(thread_size=kind[0], nut=kind[1], slot_orientation=kind[2]) for kind in KINDS * STOCKED_BOXES]
+        positions = [[(i % COLUMNS) * BOXSIZE, (i // COLUMNS) * BOXSIZE] for i in range(len(boxes))]
+        stock = [STOCK] * len(boxes)
+        (optimized, _), optimized_time = timed(lambda: module.SlotAssignment(boxes, positions, stock).assign(requests, True))
+        print("%8d %8d %11.4fs %14.0f" % (count, len(boxes), optimized_time, travel(optimized, positions, requests)))
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 400, 1000]
+    main(counts)
+    main_stocked([count for count in counts if count <= STOCK * STOCKED_BOXES * len(KINDS)])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Counts the calls to _printer.commands() (each one takes OctoPrint's comm locks and
+touches the send queue) and the number of commands per placed part, for single
+M361 lines and for one batched M361. The legacy row replays the commands the plugin
+sent before the placement plan (one call per line, sync sequence after every step)
+for the same job.
+
+Usage: python utils/benchmark_commands.py [part count]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import pnp_harness
+from benchmark_smdparts import generate_xml
+
+
+def write_gcode(folder, count):
+    path = os.path.join(folder, "benchmark.gcode")
+    with open(path, "w") as f:
+        f.write("G28\n")
+        for line in generate_xml(count).replace("><", ">\n<").splitlines():
+            f.write(";" + line + "\n")
+    return path
+
+
+def load_plugin(folder, path, count):
+    boxes = [{"thread_size": "3", "nut": "hexnut", "slot_orientation": "flat"}] * count
+    plugin = pnp_harness.create_plugin(settings={"tray": {"boxconfiguration": json.dumps(boxes)}},
+                                       data_folder=tempfile.mkdtemp(dir=folder))
+    pnp_harness.select_file(plugin, path)
+    return plugin
+
+
+def measure(folder, path, count, lines):
+    plugin = load_plugin(folder, path, count)
+    plugin._printer.print_lines(lines)
+    plugin.on_shutdown()
+    sent = [command for command in plugin._printer.sent if command not in lines]
+    return plugin._printer.calls / float(count), len(sent) / float(count)
+
+
+# the command sequence of the plugin before the placement plan, at the positions of the plan
+def legacy_commands(printer, settings, part):
+    commands = printer.commands
+    def sync(step=True):
+        commands("M400")
+        commands("G4 P1")
+        commands("M400")
+        for i in range(10):
+            commands("G4 P1")
+        if step:
+            commands("M362 OctoMagnetPNP")
+    def magnet(gcode):
+        commands("M400")
+        commands("M400")
+        commands("G4 P500")
+        for line in settings.get(["magnet", gcode]).splitlines():
+            commands(line)
+        commands("G4 P500")
+
+    sync() # M361
+    tray = part.tray_position
+    commands("T" + str(settings.get(["magnet", "extruder_nr"])))
+    commands("G1 X" + str(tray[0]) + " Y" + str(tray[1]) + " F4000")
+    commands("G1 Z" + str(tray[2] + 10))
+    magnet("release_magnet_gcode")
+    commands("G1 Z" + str(tray[2]) + "F1000")
+    magnet("grip_magnet_gcode")
+    commands("G4 P500")
+    commands("G1 Z" + str(tray[2] + 5) + "F1000")
+    sync()
+    commands("G92 E0")
+    commands("G1 E0 F1000")
+    sync()
+    destination = part.destination
+    commands("G1 Z" + str(destination[2] + 10) + " F4000")
+    commands("G1 X" + str(destination[0]) + " Y" + str(destination[1]) + " F4000")
+    commands("G1 Z" + str(destination[2]))
+    magnet("release_magnet_gcode")
+    commands("G4 P500")
+    commands("G1 Z" + str(destination[2] + 10) + " F4000")
+    commands("T0")
+    sync(step=False)
+
+
+def measure_legacy(folder, path, count):
+    plugin = load_plugin(folder, path, count)
+    printer = pnp_harness.Printer()
+    for partnr in range(1, count + 1):
+        legacy_commands(printer, plugin._settings, plugin._plan.getPart(partnr))
+    plugin.on_shutdown()
+    sent = [command for command in printer.sent if not command.startswith("M362")]
+    return printer.calls / float(count), len(sent) / float(count)
+
+
+def main(count):
+    folder = tempfile.mkdtemp()
+    try:
+        path = write_gcode(folder, count)
+        legacy = measure_legacy(folder, path, count)
+        single = measure(folder, path, count, ["M361 P%d" % i for i in range(1, count + 1)])
+        batch = measure(folder, path, count, ["M361 " + ",".join("P%d" % i for i in range(1, count + 1))])
+    finally:
+        shutil.rmtree(folder)
+    print("%d parts" % count)
+    print("%-22s %18s %18s" % ("", "calls per part", "commands per part"))
+    print("%-22s %18.1f %18.1f" % ("legacy", legacy[0], legacy[1]))
+    print("%-22s %18.1f %18.1f" % ("single M361 lines", single[0], single[1]))
+    print("%-22s %18.1f %18.1f" % ("batched M361", batch[0], batch[1]))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Micro-benchmark for the gcode queuing and sending hooks: replays a gcode file
+through both hooks the way OctoPrint calls them for every line and compares the
+time per line with the former substring checks.
+
+Usage: python utils/benchmark_hooks.py [gcode file] [line count for generated file]
+Without a file, a print job with two million move commands is generated.
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+import time
+
+import pnp_harness
+
+# same as OctoPrint's gcode_command_for_cmd
+GCODE_COMMAND = re.compile(r"^\s*([GMTF])(\d+)")
+
+
+def generated_lines(count):
+    for i in range(count):
+        if i % 10 == 0:
+            yield "G1 Z%.2f F1000" % (i * 0.0001)
+        else:
+            yield "G1 X%.3f Y%.3f E%.5f F3000" % (i % 200, (i * 7) % 200, i * 0.001)
+
+
+def file_lines(path):
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split(";", 1)[0].strip()
+            if line:
+                yield line
+
+
+def prepare(lines):
+    result = []
+    for line in lines:
+        match = GCODE_COMMAND.match(line)
+        result.append((line, match.group(1) + match.group(2) if match else None))
+    return result
+
+
+# hooks as implemented before the fast path, for comparison
+def legacy_queuing(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+    if "M361" in cmd:
+        pass
+
+def legacy_sending(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+    if "M362 OctoMagnetPNP" in cmd:
+        pass
+
+
+def replay(lines, queuing, sending):
+    start = time.perf_counter()
+    for cmd, gcode in lines:
+        queuing(None, "queuing", cmd, None, gcode)
+        sending(None, "sending", cmd, None, gcode)
+    return time.perf_counter() - start
+
+
+def main(argv):
+    if argv and not argv[0].isdigit():
+        lines = prepare(file_lines(argv[0]))
+    else:
+        lines = prepare(generated_lines(int(argv[0]) if argv else 2000000))
+    plugin = pnp_harness.create_plugin()
+
+    legacy = min(replay(lines, legacy_queuing, legacy_sending) for _ in range(3))
+    current = min(replay(lines, plugin.hook_gcode_queuing, plugin.hook_gcode_sending) for _ in range(3))
+    print("%d lines" % len(lines))
+    print("substring checks: %.3f s (%.0f ns/line)" % (legacy, 1e9 * legacy / len(lines)))
+    print("fast path:        %.3f s (%.0f ns/line)" % (current, 1e9 * current / len(lines)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Micro-benchmark for SmdParts: times load() and the getters used to build the
+FILE message for the UI against equivalent per-call XPath lookups on the
+plain XML tree.
+
+Usage: python utils/benchmark_smdparts.py [part count ...]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+import pnp_harness
+pnp_harness.load_plugin_module()
+from octoprint_OctoMagnetPNP.SmdParts import SmdParts
+
+
+def generate_xml(count):
+    parts = []
+    for i in range(1, count + 1):
+        parts.append(
+            "<part id=\"%d\" name=\"nut %d\">"
+            "<type identifier=\"hexnut\" thread_size=\"3\"/>"
+            "<orientation orientation=\"flat\"/>"
+            "<rotation z=\"%d\"/>"
+            "<size height=\"2.4\"/>"
+            "<shape><point x=\"-2.75\" y=\"-2.75\"/><point x=\"2.75\" y=\"-2.75\"/>"
+            "<point x=\"2.75\" y=\"2.75\"/><point x=\"-2.75\" y=\"2.75\"/></shape>"
+            "<destination x=\"%.3f\" y=\"%.3f\" z=\"4.8\"/>"
+            "</part>" % (i, i, i % 360, 10 + i % 100, 10 + i // 100))
+    return "<object name=\"benchmark\">" + "".join(parts) + "</object>"
+
+
+# the lookups _updateUI("FILE") and a placement need for every part, done with XPath on the raw tree
+def xpath_payload(et):
+    result = []
+    for elem in et.findall("./part"):
+        partnr = elem.get("id")
+        query = "./part[@id='" + partnr + "']"
+        result.append((
+            et.find(query).get("name"),
+            et.find(query + "/type").get("identifier"),
+            et.find(query + "/type").get("thread_size"),
+            et.find(query + "/orientation").get("orientation"),
+            [[float(p.get("x")), float(p.get("y"))] for p in et.find(query + "/shape")],
+            float(et.find(query + "/size").get("height")),
+            [float(et.find(query + "/destination").get(a)) for a in ("x", "y", "z")],
+        ))
+    return result
+
+
+def getter_payload(smdparts):
+    result = []
+    for partnr in smdparts.getPartIds():
+        result.append((
+            smdparts.getPartName(partnr),
+            smdparts.getPartType(partnr),
+            smdparts.getPartThreadSize(partnr),
+            smdparts.getPartOrientation(partnr),
+            smdparts.getPartShape(partnr),
+            smdparts.getPartHeight(partnr),
+            smdparts.getPartDestination(partnr),
+        ))
+    return result
+
+
+def best(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(counts):
+    print("%8s %12s %14s %14s %9s" % ("parts", "load [s]", "getters [s]", "xpath [s]", "speedup"))
+    for count in counts:
+        xml = generate_xml(count)
+        smdparts = SmdParts()
+        load_time = best(lambda: smdparts.load(xml))
+        et = ET.fromstring(xml)
+        getter_time = best(lambda: getter_payload(smdparts))
+        xpath_time = best(lambda: xpath_payload(et), repeat=1)
+        print("%8d %12.4f %14.4f %14.4f %8.0fx" % (count, load_time, getter_time, xpath_time, xpath_time / getter_time))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 3000])
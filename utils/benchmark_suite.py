@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark suite for loading jobs of different sizes: times the extraction of the
+part description, sanitizing, tray box assignment, compiling the placement plan
+and building the part table for the UI on generated jobs (see generate_job.py).
+
+Results are compared with the baseline in benchmark_baseline.json. A stage which
+takes more than --tolerance times its baseline (and more than MIN_SECONDS) is a
+regression, the script then exits with status 1. Use --save to store the current
+results as new baseline.
+
+Usage: python utils/benchmark_suite.py [--save] [--case name ...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pnp_harness
+import generate_job
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(UTILS_DIR, "benchmark_baseline.json")
+MIN_SECONDS = 0.01 # differences below are noise
+
+CASES = [
+    dict(name="small", parts=100, moves=10000, shape_points=4, placement="head"),
+    dict(name="medium", parts=1000, moves=100000, shape_points=4, placement="tail"),
+    dict(name="scattered", parts=1000, moves=100000, shape_points=4, placement="scattered"),
+    dict(name="shapes", parts=1000, moves=10000, shape_points=64, placement="head"),
+    dict(name="large", parts=10000, moves=1000000, shape_points=8, placement="tail"),
+]
+STAGES = ("extract", "sanitize", "assign", "compile", "payload")
+
+
+def best(function, repeat):
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        result = elapsed if result is None else min(result, elapsed)
+    return result
+
+
+def run_case(case, folder, repeat):
+    module = pnp_harness.load_plugin_module()
+    from octoprint_OctoMagnetPNP.XmlExtractor import XmlExtractor
+    from octoprint_OctoMagnetPNP.SmdParts import SmdParts
+
+    path = os.path.join(folder, case["name"] + ".gcode")
+    generate_job.write_job(path, case["parts"], case["moves"], shape_points=case["shape_points"], placement=case["placement"])
+    tray = dict(boxconfiguration=json.dumps(generate_job.box_configuration(case["parts"])))
+    plugin = pnp_harness.create_plugin(settings=dict(tray=tray), data_folder=tempfile.mkdtemp(dir=folder))
+
+    results = {}
+    results["extract"] = best(lambda: XmlExtractor().readFile(path), repeat)
+
+    # sanitizing modifies the tree, so every run gets a fresh one
+    roots = [XmlExtractor().readFile(path)[0] for _ in range(repeat)]
+    results["sanitize"] = best(lambda: SmdParts().load(roots.pop()), repeat)
+
+    smdparts = SmdParts()
+    smdparts.load(XmlExtractor().readFile(path)[0])
+    plugin.smdparts = smdparts
+    results["assign"] = best(lambda: plugin._assignTrayBoxes(), repeat)
+    positions = plugin._assignTrayBoxes()[0]
+    results["compile"] = best(lambda: plugin._compilePlan(positions), repeat)
+    plan = plugin._compilePlan(positions)
+    results["payload"] = best(lambda: plugin._buildPartTable(plan), repeat)
+    results["size"] = os.path.getsize(path)
+    os.remove(path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading of generated jobs against a stored baseline")
+    parser.add_argument("--case", action="append", help="run only the given cases")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest one counts")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed factor over the baseline")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as new baseline")
+    options = parser.parse_args()
+
+    cases = [case for case in CASES if not options.case or case["name"] in options.case]
+    try:
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)
+    except (IOError, OSError, ValueError):
+        baseline = {}
+
+    folder = tempfile.mkdtemp()
+    results = {}
+    regressions = []
+    try:
+        print("%-10s %7s %8s " % ("case", "parts", "MB") + " ".join("%17s" % stage for stage in STAGES))
+        for case in cases:
+            result = run_case(case, folder, options.repeat)
+            results[case["name"]] = result
+            columns = []
+            for stage in STAGES:
+                reference = baseline.get(case["name"], {}).get(stage)
+                if reference:
+                    columns.append("%8.4fs (%4.2fx)" % (result[stage], result[stage] / reference))
+                    if result[stage] > reference * options.tolerance and result[stage] - reference > MIN_SECONDS:
+                        regressions.append("%s/%s" % (case["name"], stage))
+                else:
+                    columns.append("%8.4fs        " % result[stage])
+            print("%-10s %7d %8.1f " % (case["name"], case["parts"], result["size"] / 1024.0 / 1024.0) + " ".join("%17s" % c for c in columns))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(folder)
+
+    if options.save:
+        baseline.update(results)
+        with open(options.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline saved to " + options.baseline)
+    elif regressions:
+        print("regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Interrupts a placement by each of the events which end a job or the connection
+and checks that the plugin is ready for the next job: the state machine is idle,
+nothing is queued and a M361 of the next job places its part.
+
+Usage: python utils/check_interruption.py
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import pnp_harness
+from benchmark_smdparts import generate_xml
+
+PART_COUNT = 3
+# events OctoPrint fires after the placement of part 1 was interrupted
+SCENARIOS = [
+    ("disconnect", ["Disconnected", "PrintFailed", "Connected"]),
+    ("print failed", ["PrintFailed"]),
+    ("print cancelled", ["PrintCancelled"]),
+]
+
+
+def write_gcode(folder):
+    path = os.path.join(folder, "interruption.gcode")
+    with open(path, "w") as f:
+        f.write("G28\n")
+        for line in generate_xml(PART_COUNT).replace("><", ">\n<").splitlines():
+            f.write(";" + line + "\n")
+    return path
+
+
+def check(folder, path, events):
+    boxes = [{"thread_size": "3", "nut": "hexnut", "slot_orientation": "flat"}] * PART_COUNT
+    plugin = pnp_harness.create_plugin(settings={"tray": {"boxconfiguration": json.dumps(boxes)}},
+                                       data_folder=tempfile.mkdtemp(dir=folder))
+    printer = plugin._printer
+    pnp_harness.select_file(plugin, path)
+    plugin.on_event("PrintStarted", {})
+
+    # the placement of part 1 starts, the sync commands which would advance it are lost
+    printer.queue_lines(["M361 P1"])
+    printer.disconnect()
+    for event in events:
+        plugin.on_event(event, {})
+    problems = []
+    if plugin._state != plugin.STATE_NONE or plugin._batch or plugin._pending or plugin._placing is not None:
+        problems.append("placement not reset")
+
+    # the next job places its parts
+    printer.connect()
+    printer.start_print()
+    plugin.on_event("PrintStarted", {})
+    if plugin._plan is None:
+        problems.append("no placement plan for the next job")
+    sent = len(printer.sent)
+    printer.print_lines(["M361 P2"])
+    if plugin._state != plugin.STATE_NONE or not any(command.startswith("G1") for command in printer.sent[sent:]):
+        problems.append("M361 of the next job not placed")
+    plugin.on_shutdown()
+    return problems
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    failed = False
+    try:
+        path = write_gcode(folder)
+        for name, events in SCENARIOS:
+            problems = check(folder, path, events)
+            failed = failed or bool(problems)
+            print("%-18s %s" % (name, ", ".join(problems) or "ok"))
+    finally:
+        shutil.rmtree(folder)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
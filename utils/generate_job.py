@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Generates synthetic print jobs with an embedded part description, for benchmarks
+of large files. The gcode is written as a stream, so files of several GB can be
+generated with little memory.
+
+The part description is placed at the head or the tail of the file, or its lines
+are scattered evenly between the print moves. One M361 line per part is spread
+over the print moves. Parts use several nut types, box_configuration() returns a
+tray configuration which holds all of them.
+
+Usage: python utils/generate_job.py [options] output.gcode
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+
+# (thread size, nut, orientation) of the generated parts
+KINDS = [("2", "hexnut", "upright"), ("2.5", "hexnut", "upright"), ("3", "hexnut", "flat"), ("8", "hexnut", "flat"),
+         ("3", "squarenut", "upright"), ("4", "squarenut", "upright"), ("6", "squarenut", "flat")]
+PLACEMENTS = ("head", "tail", "scattered")
+WRITE_LINES = 10000 # lines per write
+MOVE_LENGTH = 40 # average bytes per print move
+
+
+def part_kind(partnr):
+    return KINDS[partnr % len(KINDS)]
+
+
+# XML lines of a single part with a regular polygon of shape_points points as outline
+def part_lines(partnr, shape_points, rng):
+    thread_size, nut, orientation = part_kind(partnr)
+    radius = float(thread_size)
+    lines = ["<part id=\"%d\" name=\"nut %d\">" % (partnr, partnr),
+             "  <type identifier=\"%s\" thread_size=\"%s\"/>" % (nut, thread_size),
+             "  <orientation orientation=\"%s\"/>" % orientation,
+             "  <rotation z=\"%d\"/>" % rng.randrange(360),
+             "  <size height=\"%.1f\"/>" % (radius * 0.8),
+             "  <shape>"]
+    for i in range(shape_points):
+        angle = 2 * math.pi * i / shape_points
+        lines.append("    <point x=\"%.3f\" y=\"%.3f\"/>" % (radius * math.cos(angle), radius * math.sin(angle)))
+    lines += ["  </shape>",
+              "  <destination x=\"%.3f\" y=\"%.3f\" z=\"%.1f\"/>" % (rng.uniform(20, 180), rng.uniform(20, 180), rng.choice((2.4, 4.8, 7.2))),
+              "</part>"]
+    return lines
+
+
+def xml_lines(parts, shape_points=4, seed=1):
+    rng = random.Random(seed)
+    yield "<object name=\"generated\">"
+    for partnr in range(1, parts + 1):
+        for line in part_lines(partnr, shape_points, rng):
+            yield line
+    yield "</object>"
+
+
+# tray configuration with one box per nut type, holding all parts of that type
+def box_configuration(parts):
+    counts = collections.Counter(part_kind(partnr) for partnr in range(1, parts + 1))
+    return [dict(thread_size=kind[0], nut=kind[1], slot_orientation=kind[2], count=counts[kind]) for kind in KINDS if counts[kind]]
+
+
+def print_moves(moves, parts):
+    interval = max(1, moves // parts) if parts else None
+    partnr = 1
+    for i in range(moves):
+        if i % 1000 == 0:
+            yield "G1 Z%.2f F1000" % (0.2 + i // 1000 * 0.2)
+        yield "G1 X%.3f Y%.3f E%.5f F3000" % (20 + (i * 13) % 160, 20 + (i * 7) % 160, i * 0.02)
+        if interval and i % interval == interval - 1 and partnr <= parts:
+            yield "M361 P%d" % partnr
+            partnr += 1
+
+
+# Write a job to path. With size (bytes), the number of print moves is chosen to get a file of about this size.
+# Returns the number of print moves.
+def write_job(path, parts, moves=0, size=None, shape_points=4, placement="tail", seed=1):
+    if placement not in PLACEMENTS:
+        raise ValueError("placement must be one of " + ", ".join(PLACEMENTS))
+    if size is not None:
+        moves = max(moves, size // MOVE_LENGTH)
+    xml = ("; " + line for line in xml_lines(parts, shape_points, seed))
+    gcode = print_moves(moves, parts)
+    if placement == "head":
+        lines = _chain(["G28", "G90"], xml, gcode)
+    elif placement == "tail":
+        lines = _chain(["G28", "G90"], gcode, xml)
+    else:
+        lines = _chain(["G28", "G90"], _interleave(gcode, moves, xml, parts * (shape_points + 9) + 2))
+
+    with open(path, "w") as f:
+        buf = []
+        for line in lines:
+            buf.append(line)
+            if len(buf) >= WRITE_LINES:
+                f.write("\n".join(buf) + "\n")
+                buf = []
+        if buf:
+            f.write("\n".join(buf) + "\n")
+    return moves
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+
+# spread the lines of b evenly between the lines of a
+def _interleave(a, a_count, b, b_count):
+    step = float(a_count + 1) / (b_count + 1)
+    position = step
+    for i, line in enumerate(a):
+        while position <= i + 1:
+            line_b = next(b, None)
+            if line_b is not None:
+                yield line_b
+            position += step
+        yield line
+    for line in b:
+        yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a print job with an embedded part description")
+    parser.add_argument("output")
+    parser.add_argument("--parts", type=int, default=100)
+    parser.add_argument("--moves", type=int, default=10000, help="number of print moves")
+    parser.add_argument("--size", type=float, help="approximate file size in MB, adds print moves")
+    parser.add_argument("--shape-points", type=int, default=4)
+    parser.add_argument("--placement", choices=PLACEMENTS, default="tail")
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+
+    moves = write_job(options.output, options.parts, options.moves,
+                      int(options.size * 1024 * 1024) if options.size else None,
+                      options.shape_points, options.placement, options.seed)
+    print("%s: %d parts, %d print moves, %.1f MB" % (options.output, options.parts, moves,
+                                                       os.path.getsize(options.output) / 1024.0 / 1024.0))
+    print("tray configuration:")
+    print(json.dumps(box_configuration(options.parts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+# coding=utf-8
+"""
+Helpers to run OctoMagnetPNP outside of OctoPrint, used by the benchmark scripts
+in this folder.
+
+If OctoPrint is not installed, minimal stand-ins for the octoprint.plugin mixins
+are registered so the plugin module can be imported. Printer, settings and
+plugin manager are replaced by simple recording objects. VirtualPrinter adds a
+simulated clock with serial latency, planner buffer and move durations.
+"""
+
+from __future__ import print_function
+
+import collections
+import logging
+import math
+import os
+import re
+import sys
+import types
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load_plugin_module():
+    try:
+        import octoprint.plugin
+    except ImportError:
+        _register_octoprint_standins()
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    import octoprint_OctoMagnetPNP
+    return octoprint_OctoMagnetPNP
+
+
+def _register_octoprint_standins():
+    octoprint = types.ModuleType("octoprint")
+    plugin = types.ModuleType("octoprint.plugin")
+    for name in ("StartupPlugin", "TemplatePlugin", "EventHandlerPlugin", "SettingsPlugin",
+                 "AssetPlugin", "SimpleApiPlugin", "BlueprintPlugin", "ShutdownPlugin"):
+        setattr(plugin, name, type(name, (object,), {}))
+    plugin.BlueprintPlugin.route = staticmethod(lambda rule, **options: (lambda f: f))
+    plugin.SettingsPlugin.on_settings_save = lambda self, data: data
+    plugin.plugin_manager = lambda: PluginManager()
+    octoprint.plugin = plugin
+    sys.modules["octoprint"] = octoprint
+    sys.modules["octoprint.plugin"] = plugin
+
+    # flask is installed along with OctoPrint
+    try:
+        import flask
+    except ImportError:
+        flask = types.ModuleType("flask")
+        flask.jsonify = lambda *args, **kwargs: dict(*args, **kwargs)
+        flask.Response = lambda response=None, **kwargs: response
+        sys.modules["flask"] = flask
+
+
+class Settings(object):
+    """Nested dict settings with the subset of the OctoPrint settings API used by the plugin."""
+
+    def __init__(self, defaults, overrides=None, basefolder=None):
+        self._data = _merge(defaults, overrides or {})
+        self._basefolder = basefolder
+
+    def get(self, path, **kwargs):
+        value = self._data
+        for key in path:
+            value = value[key]
+        return value
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def get_int(self, path, **kwargs):
+        return int(self.get(path))
+
+    def get_float(self, path, **kwargs):
+        return float(self.get(path))
+
+    def set(self, path, value, **kwargs):
+        data = self._data
+        for key in path[:-1]:
+            data = data.setdefault(key, {})
+        data[path[-1]] = value
+
+    def global_get_basefolder(self, folder, **kwargs):
+        return self._basefolder
+
+
+def _merge(defaults, overrides):
+    result = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+class Printer(object):
+    """
+    Emulates OctoPrint's command processing for a printer which is currently printing: every
+    command passes the queuing hook, then the sending hook and is recorded in sent unless a hook
+    suppressed it. Job lines are only accepted while the job is not paused.
+    """
+
+    Z_PARAMETER = re.compile(r"\bZ(-?[\d.]+)")
+
+    def __init__(self):
+        self.plugin = None
+        self.sent = []
+        self.calls = 0
+        self.current_z = None # height of the last move with Z, like OctoPrint's currentZ
+        self._queue = collections.deque()
+        self._state = "printing"
+
+    # feed the lines of a print job, each one is processed completely before the next one is read
+    def print_lines(self, lines):
+        for line in lines:
+            self.queue_lines([line])
+            self._drain()
+
+    # pass lines of a print job through the queuing hook without sending anything, see disconnect()
+    def queue_lines(self, lines):
+        for line in lines:
+            line = line.split(";", 1)[0].strip()
+            if not line:
+                continue
+            if self._state != "printing":
+                raise RuntimeError("job line while printer is " + self._state + ": " + line)
+            self._enqueue(line)
+
+    # the connection was lost, commands which were not sent yet are dropped
+    def disconnect(self):
+        self._queue.clear()
+        self._state = "offline"
+
+    def connect(self):
+        self._state = "operational"
+
+    def start_print(self):
+        self._state = "printing"
+
+    def commands(self, commands, **kwargs):
+        self.calls += 1
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        for command in commands:
+            self._enqueue(command)
+        if self.plugin is None:
+            self._drain()
+
+    def _enqueue(self, command):
+        if self.plugin is None:
+            self._queue.append(command)
+            return
+        self._queue.extend(_hook_result(self.plugin.hook_gcode_queuing(None, "queuing", command, None, gcode_command(command)), command))
+
+    def _drain(self):
+        while self._queue:
+            command = self._queue.popleft()
+            if self.plugin is not None:
+                result = _hook_result(self.plugin.hook_gcode_sending(None, "sending", command, None, gcode_command(command)), command)
+            else:
+                result = [command]
+            self._track(result)
+            self.sent.extend(result)
+
+    # update current_z from sent moves
+    def _track(self, commands):
+        for command in commands:
+            if gcode_command(command) in ("G0", "G1"):
+                match = self.Z_PARAMETER.search(command)
+                if match:
+                    self.current_z = float(match.group(1))
+
+    def get_current_data(self):
+        return dict(currentZ=self.current_z)
+
+    def is_printing(self):
+        return self._state == "printing"
+
+    def is_resuming(self):
+        return False
+
+    def is_paused(self):
+        return self._state == "paused"
+
+    def is_pausing(self):
+        return False
+
+    def pause_print(self, **kwargs):
+        self._state = "paused"
+
+    def resume_print(self, **kwargs):
+        self._state = "printing"
+
+    def cancel_print(self, **kwargs):
+        self._state = "cancelled"
+
+
+class VirtualPrinter(Printer):
+    """
+    Printer with a simulated clock, nothing is actually waited for.
+
+    Commands are sent one at a time and the next one only after the previous one was
+    acknowledged, like OctoPrint does. Each command costs one round trip of latency
+    seconds. Moves are acknowledged as soon as they fit into the planner buffer of
+    buffer_depth moves and are executed one after another with the duration given by
+    their feedrate, without acceleration. M400, G4, G28 and tool changes wait for all
+    moves to finish before they are acknowledged.
+    """
+
+    MOVES = ("G0", "G1")
+    WAITING = ("M400", "G4", "G28")
+    PARAMETER = re.compile(r"([XYZEFP])(-?[\d.]+)")
+
+    def __init__(self, latency=0.005, buffer_depth=16, home_time=10.0, tool_change_time=0.0):
+        Printer.__init__(self)
+        self.latency = latency
+        self.buffer_depth = buffer_depth
+        self.home_time = home_time
+        self.tool_change_time = tool_change_time
+        self.time = 0.0 # host clock: the last command was acknowledged at this time
+        self.round_trips = 0
+        self._moves = collections.deque() # end times of the moves in the planner buffer
+        self._motionEnd = 0.0
+        self._position = dict(X=0.0, Y=0.0, Z=0.0, E=0.0)
+        self._feedrate = 3000.0
+        self._relative = False
+
+    # clock for the plugin's metrics
+    def now(self):
+        return self.time
+
+    # time when the printer finished everything sent so far
+    def finished(self):
+        return max(self.time, self._motionEnd)
+
+    def _drain(self):
+        while self._queue:
+            command = self._queue.popleft()
+            if self.plugin is not None:
+                result = _hook_result(self.plugin.hook_gcode_sending(None, "sending", command, None, gcode_command(command)), command)
+            else:
+                result = [command]
+            for sent in result:
+                self._execute(sent)
+            self._track(result)
+            self.sent.extend(result)
+
+    def _execute(self, command):
+        self.round_trips += 1
+        arrival = self.time + self.latency / 2
+        code = gcode_command(command) or ""
+        parameters = dict((name, float(value)) for name, value in self.PARAMETER.findall(command.split(";", 1)[0]))
+        if code in self.MOVES:
+            duration = self._move(parameters)
+            # wait for a free slot in the planner buffer
+            while self._moves and self._moves[0] <= arrival:
+                self._moves.popleft()
+            if len(self._moves) >= self.buffer_depth:
+                arrival = self._moves.popleft()
+            self._motionEnd = max(arrival, self._motionEnd) + duration
+            self._moves.append(self._motionEnd)
+        elif code == "G90" or code == "G91":
+            self._relative = code == "G91"
+        elif code == "G92":
+            self._position.update((axis, value) for axis, value in parameters.items() if axis in self._position)
+        elif code in self.WAITING or code.startswith("T"):
+            arrival = max(arrival, self._motionEnd)
+            if code == "G4":
+                arrival += parameters.get("P", 0.0) / 1000.0
+            elif code == "G28":
+                arrival += self.home_time
+                self._position.update(X=0.0, Y=0.0, Z=0.0)
+            elif code.startswith("T"):
+                arrival += self.tool_change_time
+            self._moves.clear()
+            self._motionEnd = arrival
+        self.time = arrival + self.latency / 2
+
+    # update position and feedrate, returns the duration of the move in seconds
+    # like Marlin, the feedrate applies to the XYZ distance, E only counts for moves of E alone
+    def _move(self, parameters):
+        self._feedrate = parameters.get("F", self._feedrate)
+        distances = {}
+        for axis in ("X", "Y", "Z", "E"):
+            if axis in parameters:
+                target = self._position[axis] + parameters[axis] if self._relative else parameters[axis]
+                distances[axis] = (target - self._position[axis]) ** 2
+                self._position[axis] = target
+        distance = distances.get("X", 0.0) + distances.get("Y", 0.0) + distances.get("Z", 0.0) or distances.get("E", 0.0)
+        return math.sqrt(distance) * 60.0 / self._feedrate if self._feedrate > 0 else 0.0
+
+
+GCODE_COMMAND = re.compile(r"^\s*([GMTF])(\d+)")
+
+# command code like OctoPrint's gcode_command_for_cmd, e.g. "G1" or "M361"
+def gcode_command(cmd):
+    match = GCODE_COMMAND.match(cmd)
+    return match.group(1) + match.group(2) if match else None
+
+# commands resulting from the return value of a queuing or sending hook
+def _hook_result(result, command):
+    if result is None:
+        return [command]
+    if isinstance(result, tuple):
+        return [] if result[0] is None else [result[0]]
+    if isinstance(result, list):
+        return [item[0] if isinstance(item, tuple) else item for item in result]
+    return [result]
+
+
+class PrinterProfileManager(object):
+    def __init__(self, width=200, depth=200, height=200, origin="lowerleft"):
+        self.profile = dict(volume=dict(width=width, depth=depth, height=height, origin=origin, custom_box=False))
+
+    def get_current_or_default(self):
+        return self.profile
+
+
+class PluginManager(object):
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, plugin, data):
+        self.messages.append(data)
+
+
+def create_plugin(settings=None, printer=None, data_folder=None):
+    module = load_plugin_module()
+    plugin = module.OctoMagnetPNP()
+    plugin._settings = Settings(plugin.get_settings_defaults(), settings)
+    plugin._printer = printer or Printer()
+    plugin._printer.plugin = plugin
+    plugin._logger = logging.getLogger("octoprint.plugins.OctoMagnetPNP")
+    plugin._pluginManager = PluginManager()
+    plugin._printer_profile_manager = PrinterProfileManager()
+    if data_folder is not None:
+        plugin.get_plugin_data_folder = lambda: data_folder
+        plugin.initialize()
+    return plugin
+
+
+# select a gcode file like OctoPrint does and wait until its part information is loaded
+def select_file(plugin, path):
+    plugin.on_event("FileSelected", dict(file=path))
+    plugin._waitForParts(600)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Offline simulation of print jobs with M361 placements on a virtual printer, see
+pnp_harness.VirtualPrinter. Needs neither OctoPrint nor a printer, all times are
+simulated and the results are repeatable.
+
+Reports the commands sent to the printer, the number of synchronizations of the
+state machine, the simulated time per placed part and for the whole job.
+
+Usage: python utils/simulate.py [options] [gcode file ...]
+Without files, a suite of generated jobs and utils/testfile_short.gcode is simulated.
+Parts without <type> or <orientation>, like those of testfile_short.gcode, get the
+nut type of --part-type and, unless the settings contain a box configuration, a
+box holding their nuts.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import pnp_harness
+from benchmark_smdparts import generate_xml
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+SUITE = [("generated", 1), ("generated", 10), ("generated", 100), ("file", os.path.join(UTILS_DIR, "testfile_short.gcode"))]
+
+
+# print job with moves between the placements and the part description at the end
+def write_job(folder, count, moves_per_part=20):
+    path = os.path.join(folder, "job_%d.gcode" % count)
+    with open(path, "w") as f:
+        f.write("G28\nG90\n")
+        for partnr in range(1, count + 1):
+            for i in range(moves_per_part):
+                f.write("G1 X%.3f Y%.3f E%.5f F3000\n" % (50 + (i * 13) % 100, 50 + (i * 7) % 100, partnr + i * 0.01))
+            f.write("M361 P%d\n" % partnr)
+        for line in generate_xml(count).replace("><", ">\n<").splitlines():
+            f.write(";" + line + "\n")
+    return path
+
+
+# Copy of the job in folder where the parts without <type> or <orientation> have the nut type kind
+# (thread size, nut, orientation). Returns the path of the copy and the number of completed parts.
+def add_part_types(folder, path, kind):
+    lines = []
+    part = None
+    completed = 0
+    with open(path, "r") as f:
+        for line in f:
+            tag = line.lstrip("; \t")
+            if tag.startswith("<part"):
+                part = []
+            elif part is not None and tag.startswith("</part>"):
+                missing = []
+                if not any(child.startswith("<type") for child in part):
+                    missing.append(';  <type identifier="%s" thread_size="%s"/>\n' % (kind[1], kind[0]))
+                if not any(child.startswith("<orientation") for child in part):
+                    missing.append(';  <orientation orientation="%s"/>\n' % kind[2])
+                lines.extend(missing)
+                completed += 1 if missing else 0
+                part = None
+            elif part is not None:
+                part.append(tag)
+            lines.append(line)
+    if not completed:
+        return path, 0
+    copy = os.path.join(folder, os.path.basename(path))
+    with open(copy, "w") as f:
+        f.writelines(lines)
+    return copy, completed
+
+
+def job_lines(path):
+    with open(path, "r") as f:
+        return [line for line in (line.split(";", 1)[0].strip() for line in f) if line]
+
+
+def simulate(path, settings, options):
+    printer = pnp_harness.VirtualPrinter(latency=options.latency, buffer_depth=options.buffer_depth)
+    plugin = pnp_harness.create_plugin(settings=settings, printer=printer,
+                                       data_folder=tempfile.mkdtemp(dir=options.folder))
+    plugin._metrics = pnp_harness.load_plugin_module().PlacementMetrics(clock=printer.now)
+    pnp_harness.select_file(plugin, path)
+    plugin.on_event("PrintStarted", dict(path=path))
+    if printer.is_printing():
+        printer.print_lines(job_lines(path))
+    plugin.on_shutdown()
+
+    phases = {}
+    for phase in plugin._metrics.toDict()["phases"]:
+        total = phases.setdefault(phase["phase"], [0, 0.0])
+        total[0] += phase["count"]
+        total[1] += phase["sum"]
+    parts, placement = phases.get("part", (0, 0.0))
+    return dict(
+        parts = parts,
+        commands = len(printer.sent),
+        round_trips = printer.round_trips,
+        syncs = sum(count for count, _ in phases.values()) - parts,
+        per_part = placement / parts if parts else 0.0,
+        phases = dict((phase, total / count) for phase, (count, total) in phases.items()),
+        total = printer.finished(),
+        cancelled = not printer.is_printing() and not printer.is_paused()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate print jobs with M361 placements on a virtual printer")
+    parser.add_argument("files", nargs="*", help="gcode files to replay")
+    parser.add_argument("--parts", type=int, action="append", help="simulate a generated job with this many parts")
+    parser.add_argument("--latency", type=float, default=0.005, help="serial round trip time in seconds")
+    parser.add_argument("--buffer-depth", type=int, default=16, help="moves in the planner buffer")
+    parser.add_argument("--settings", type=json.loads, default={}, help="plugin settings as JSON")
+    parser.add_argument("--part-type", type=lambda value: value.split(","), default=["3", "hexnut", "flat"],
+                        help="thread size, nut and orientation of parts without type, e.g. 3,hexnut,flat")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    options = parser.parse_args()
+
+    if options.files or options.parts:
+        jobs = [("file", path) for path in options.files] + [("generated", count) for count in options.parts or []]
+    else:
+        jobs = SUITE
+
+    options.folder = tempfile.mkdtemp()
+    results = []
+    try:
+        for kind, job in jobs:
+            settings = options.settings
+            if kind == "generated":
+                # a single box holding all nuts of the job
+                tray = dict(boxconfiguration=json.dumps([dict(thread_size="3", nut="hexnut", slot_orientation="flat", count=job)]))
+                settings = pnp_harness._merge(dict(tray=tray), options.settings)
+                name = "generated, %d parts" % job
+                job = write_job(options.folder, job)
+            else:
+                name = os.path.basename(job)
+                job, completed = add_part_types(options.folder, job, options.part_type)
+                if completed and "boxconfiguration" not in options.settings.get("tray", {}):
+                    box = dict(thread_size=options.part_type[0], nut=options.part_type[1], slot_orientation=options.part_type[2],
+                               count=completed)
+                    settings = pnp_harness._merge(dict(tray=dict(boxconfiguration=json.dumps([box]))), options.settings)
+            result = simulate(job, settings, options)
+            result["job"] = name
+            results.append(result)
+    finally:
+        shutil.rmtree(options.folder)
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("latency %.1f ms, planner buffer %d moves" % (options.latency * 1000, options.buffer_depth))
+    print("%-26s %6s %9s %11s %6s %10s %11s" % ("job", "parts", "commands", "round trips", "syncs", "s per part", "job time s"))
+    for result in results:
+        print("%-26s %6d %9d %11d %6d %10.2f %11.1f%s" % (result["job"], result["parts"], result["commands"], result["round_trips"],
+                                                       result["syncs"], result["per_part"], result["total"],
+                                                       " (cancelled)" if result["cancelled"] else ""))
+
+
+if __name__ == "__main__":
+    main()